@@ -15,6 +15,7 @@ from flask import Flask, request
 import models
 
 from dbsync import models as synchmodels, server
+from dbsync.messages import binary
 
 
 app = Flask(__name__)
@@ -26,6 +27,32 @@ def enc(string):
     return u"".join(table.get(c, c) for c in string)
 
 
+def native():
+    "Whether the node accepts binary responses."
+    return binary.accepts(request.headers.get("Accept"))
+
+
+def respond(dict_, code=200):
+    "Encodes a response with the codec accepted by the node."
+    if native():
+        return (binary.dumps(dict_), code,
+                {"Content-Type": binary.CONTENT_TYPE})
+    return (json.dumps(dict_), code, {"Content-Type": "application/json"})
+
+
+def binary_body():
+    "Whether the body of the request is encoded with the binary codec."
+    return request.headers.get("Content-Type", "").startswith(
+        binary.CONTENT_TYPE)
+
+
+def body():
+    "Decodes the body of the request, in either codec."
+    if binary_body():
+        return binary.loads(request.get_data())
+    return request.json
+
+
 @app.route("/")
 def root():
     return 'Ping: any method <a href="/ping">/ping</a><br />'\
@@ -45,25 +72,18 @@ def ping():
 
 @app.route("/repair", methods=["GET"])
 def repair():
-    return (json.dumps(server.handle_repair(request.args)),
-            200,
-            {"Content-Type": "application/json"})
+    return respond(server.handle_repair(request.args, native=native()))
 
 
 @app.route("/register", methods=["POST"])
 def register():
-    return (json.dumps(server.handle_register()),
-            200,
-            {"Content-Type": "application/json"})
+    return respond(server.handle_register(native=native()))
 
 
 @app.route("/pull", methods=["POST"])
 def pull():
-    print json.dumps(request.json, indent=2)
     try:
-        return (json.dumps(server.handle_pull(request.json)),
-                200,
-                {"Content-Type": "application/json"})
+        return respond(server.handle_pull(body(), native=native()))
     except server.handlers.PullRejected as e:
         return (json.dumps({'error': [repr(arg) for arg in e.args]}),
                 400,
@@ -72,9 +92,8 @@ def pull():
 
 @app.route("/push", methods=["POST"])
 def push():
-    print json.dumps(request.json, indent=2)
     try:
-        return (json.dumps(server.handle_push(request.json)),
+        return (json.dumps(server.handle_push(body(), native=binary_body())),
                 200,
                 {"Content-Type": "application/json"})
     except server.handlers.PullSuggested as e:
@@ -90,9 +109,7 @@ def push():
 
 @app.route("/query", methods=["GET"])
 def query():
-    return (json.dumps(server.handle_query(request.args)),
-            200,
-            {"Content-Type": "application/json"})
+    return respond(server.handle_query(request.args, native=native()))
 
 
 @app.route("/inspect", methods=["GET"])
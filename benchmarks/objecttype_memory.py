@@ -0,0 +1,61 @@
+"""
+Memory used by the wrapped objects of a message payload.
+
+Compares the compact ObjectType against the previous implementation,
+which stored every column in the instance dictionary plus a list of
+keys. Run with ``python benchmarks/objecttype_memory.py``.
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dbsync.messages.base import ObjectType
+
+
+class LegacyObjectType(object):
+    "The previous wrapper, kept here for comparison."
+
+    def __init__(self, mname, pk, **kwargs):
+        self.__model_name__ = mname
+        self.__pk__ = pk
+        self.__keys__ = []
+        for k, v in kwargs.iteritems():
+            if k != '__model_name__' and k != '__pk__' and k != '__keys__':
+                setattr(self, k, v)
+                self.__keys__.append(k)
+
+
+def legacy_size(obj):
+    return sys.getsizeof(obj) + \
+        sys.getsizeof(obj.__dict__) + \
+        sys.getsizeof(obj.__keys__)
+
+
+def compact_size(obj):
+    # the layout is shared by every object of the model
+    return sys.getsizeof(obj) + sys.getsizeof(obj._values)
+
+
+def row(i, columns):
+    dict_ = dict(("column_{0}".format(c), i * c) for c in xrange(columns))
+    dict_['id'] = i
+    return dict_
+
+
+def main(rows=100000, columns=20):
+    data = [row(i, columns) for i in xrange(rows)]
+    legacy = [LegacyObjectType(u"Model", d['id'], **d) for d in data]
+    compact = [ObjectType.from_dict(u"Model", d['id'], d) for d in data]
+    legacy_total = sum(legacy_size(o) for o in legacy)
+    compact_total = sum(compact_size(o) for o in compact)
+    print "{0} rows of {1} columns (values excluded)".format(rows, columns + 1)
+    print "legacy:  {0:>12,} bytes ({1:.1f} per object)".format(
+        legacy_total, legacy_total / float(rows))
+    print "compact: {0:>12,} bytes ({1:.1f} per object)".format(
+        compact_total, compact_total / float(rows))
+    print "ratio:   {0:.2f}".format(compact_total / float(legacy_total))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,83 @@
+"""
+Cost of signing and verifying push messages, in microseconds per
+operation.
+
+Compares the incremental digest of dbsync.messages.push against the
+previous implementation, which concatenated the whole signed text
+before hashing it and queried the node on each verification. Also
+reports the largest piece of signed text held in memory by each. Run with
+``python benchmarks/push_signature.py [operations] [pushes]``.
+"""
+
+import sys
+import os
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import time
+import hashlib
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from dbsync import models
+from dbsync.utils import generate_secret
+from dbsync.messages import push
+
+
+def legacy_sign(secret, operations):
+    portion = "".join("&{0}#{1}#{2}".\
+                          format(op.row_id, op.content_type_id, op.command)
+                      for op in operations)
+    return hashlib.sha512(secret + portion).hexdigest()
+
+
+def legacy_islegit(key, node_id, operations, session):
+    node = session.query(models.Node).\
+        filter(models.Node.node_id == node_id).first()
+    return node is not None and key == legacy_sign(node.secret, operations)
+
+
+def per_operation(proc, operations, repeat):
+    "Microseconds per operation, over *repeat* calls of *proc*."
+    start = time.time()
+    for _ in xrange(repeat):
+        proc()
+    return (time.time() - start) * 1e6 / (repeat * len(operations))
+
+
+def main(n=100000, pushes=20):
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    node = models.Node(secret=generate_secret(128))
+    session.add(node)
+    session.commit()
+    operations = [models.Operation(row_id=i, content_type_id=i % 7,
+                                   command="iud"[i % 3])
+                  for i in xrange(n)]
+    message = push.PushMessage()
+    message.operations = operations
+    message.set_node(node)
+    assert message.key == legacy_sign(node.secret, operations)
+    report = [
+        ("sign legacy", per_operation(
+                lambda: legacy_sign(node.secret, operations),
+                operations, pushes)),
+        ("sign incremental", per_operation(
+                message._sign, operations, pushes)),
+        ("verify legacy", per_operation(
+                lambda: legacy_islegit(
+                    message.key, node.node_id, operations, session),
+                operations, pushes)),
+        ("verify cached", per_operation(
+                lambda: message.islegit(session), operations, pushes))]
+    for name, cost in report:
+        print "{0:<17} {1:>8.3f} us/op".format(name, cost)
+    text = lambda ops: sum(len("&{0}#{1}#{2}".format(
+                op.row_id, op.content_type_id, op.command)) for op in ops)
+    print "largest signed text: legacy {0:,} bytes, incremental {1:,} bytes"\
+        .format(text(operations), text(operations[:push._digest_batch]))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
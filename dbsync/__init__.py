@@ -5,10 +5,12 @@ Top-level exports, for convenience.
 import dbsync.core
 from dbsync.core import (
     is_synched,
+    sync_status,
     generate_content_types,
     set_engine,
     get_engine,
-    save_extensions)
+    save_extensions,
+    upgrade_schema)
 from dbsync.models import Base
 from dbsync.logs import set_log_target
 
@@ -20,6 +22,7 @@ __version__ = '.'.join(str(n) for n in __version_info__)
 def create_all():
     "Issues DDL commands."
     Base.metadata.create_all(get_engine())
+    upgrade_schema()
 
 
 def drop_all():
@@ -7,8 +7,10 @@ yet.
 """
 
 import inspect
+import json
 
 from dbsync.client.compression import unsynched_objects, trim
+from dbsync.client import tracking
 from dbsync.client.tracking import track
 from dbsync.core import extend
 from dbsync.client.register import (
@@ -23,6 +25,7 @@ from dbsync.client.ping import isconnected, isready
 from dbsync.client.repair import repair
 from dbsync.client.serverquery import query_server
 from dbsync.client import net
+from dbsync.messages import binary
 
 
 def set_pull_suggestion_criterion(predicate):
@@ -76,6 +79,67 @@ def set_default_headers(hhs):
     net.default_headers = hhs
 
 
+def set_binary_codec():
+    """
+    Makes the binary codec (dbsync.messages.binary) the default for
+    requests sent to the server, and asks the server to use it for the
+    responses too. Other default headers are kept.
+
+    Requests are always encoded with the binary codec afterwards, so
+    the server must be able to decode it (see the README). Responses
+    in JSON are still accepted. Use ``set_json_codec`` to go back to
+    JSON.
+    """
+    net.default_encoder = binary.dumps
+    net.default_headers = dict(net.default_headers, **{
+            "Content-Type": binary.CONTENT_TYPE,
+            "Accept": "{0}, application/json;q=0.5".format(
+                binary.CONTENT_TYPE)})
+
+
+def set_json_codec():
+    """
+    Makes JSON the codec for requests sent to the server and for the
+    responses, which is the default. Other default headers are kept.
+    """
+    net.default_encoder = json.dumps
+    net.default_headers = dict(net.default_headers, **{
+            "Content-Type": "application/json",
+            "Accept": "application/json"})
+
+
+def set_capture_mode(mode):
+    """
+    Sets the way operations are written to the database, one of
+    ``dbsync.client.tracking.capture_modes``. Default is
+    'after_commit', which writes them in a separate transaction after
+    each commit. 'in_transaction' inserts them in bulk within the
+    transaction of the application, before it's committed. 'triggers'
+    installs database triggers that register the operations (SQLite
+    only), which requires the engine to be set.
+    """
+    assert mode in tracking.capture_modes, "invalid capture mode"
+    if mode == 'triggers' and tracking.capture_mode != 'triggers':
+        tracking.install_triggers()
+    elif mode != 'triggers' and tracking.capture_mode == 'triggers':
+        tracking.uninstall_triggers()
+    tracking.capture_mode = mode
+    return mode
+
+
+def set_coalescing(enabled=True):
+    """
+    Sets whether operations are coalesced as they're written: each
+    new operation is merged with the unversioned operation of the same
+    row, if any, following the compression rules, so the operations
+    log keeps at most one unversioned operation for each dirty
+    row. Default is ``False``. Operations registered by triggers or
+    bulk statements are still compressed before each push and pull.
+    """
+    tracking.coalescing = bool(enabled)
+    return tracking.coalescing
+
+
 def set_default_timeout(t):
     """
     Sets the default timeout in seconds for all HTTP requests. Default
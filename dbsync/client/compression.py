@@ -4,10 +4,13 @@ Operation compression, both in-memory and in-database.
 
 import warnings
 
+from sqlalchemy import select
+
 from dbsync.lang import *
-from dbsync.utils import get_pk, query_model
+from dbsync.utils import get_pk
 from dbsync import core
 from dbsync.models import Version, Operation
+from dbsync.messages.records import OperationRecord
 from dbsync.logs import get_logger
 
 
@@ -55,20 +58,41 @@ def _assert_operation_sequence(seq, session=None):
                 seq)
 
 
-@core.session_committing
-def compress(session=None):
+def merged_changes(seq):
     """
-    Compresses unversioned operations in the database.
+    Returns the changed columns of the update equivalent to the
+    sequence of updates *seq*: the union of theirs, or ``None`` if any
+    of them changed the whole row.
+    """
+    changed = set()
+    for op in seq:
+        if not op.changed_columns:
+            return None
+        changed.update(op.changed_columns.split(","))
+    return ",".join(sorted(changed))
 
-    For each row in the operations table, this deletes unnecesary
-    operations that would otherwise bloat the message.
 
-    This procedure is called internally before the 'push' request
-    happens, and before the local 'merge' happens.
+def _existing_pks(model, pks, session):
+    "Returns the subset of *pks* with a backing row of *model*."
+    pk = getattr(model, get_pk(model))
+    existing = set()
+    for batch in grouper(pks, core.MAX_SQL_VARIABLES):
+        existing.update(
+            row[0] for row in session.query(pk).filter(pk.in_(list(batch))))
+    return existing
+
+
+def _redundant_operations(unversioned, session):
+    """
+    Returns the set of operations in *unversioned*, sorted from newest
+    to oldest, that compression discards. Updates left in place of a
+    sequence of updates get the changed columns of all of them.
+
+    The database isn't modified: it's only queried once for each
+    tracked model to check which objects still exist.
     """
-    unversioned = session.query(Operation).\
-        filter(Operation.version_id == None).order_by(Operation.order.desc())
     seqs = group_by(lambda op: (op.row_id, op.content_type_id), unversioned)
+    deleted = set()
 
     # Check errors on sequences
     for seq in seqs.itervalues():
@@ -78,67 +102,107 @@ def compress(session=None):
         if seq[-1].command == 'i':
             if all(op.command == 'u' for op in seq[:-1]):
                 # updates are superfluous
-                map(session.delete, seq[:-1])
+                deleted.update(seq[:-1])
             elif seq[0].command == 'd':
                 # it's as if the object never existed
-                map(session.delete, seq)
+                deleted.update(seq)
         elif seq[-1].command == 'u':
             if all(op.command == 'u' for op in seq[:-1]):
-                # leave a single update
-                map(session.delete, seq[1:])
+                # leave a single update, with the columns of all
+                seq[0].changed_columns = merged_changes(seq)
+                deleted.update(seq[1:])
             elif seq[0].command == 'd':
                 # leave the delete statement
-                map(session.delete, seq[1:])
-    session.flush()
+                deleted.update(seq[1:])
 
     # repair inconsistencies
-    for operation in session.query(Operation).\
-            filter(Operation.version_id == None).\
-            order_by(Operation.order.desc()).all():
-        session.flush()
+    remaining = [op for op in unversioned if op not in deleted]
+    required = {}
+    for op in remaining:
+        model = op.tracked_model
+        if model and op.command in ('i', 'u'):
+            required.setdefault(model, set()).add(op.row_id)
+    existing = dict((model, _existing_pks(model, pks, session))
+                    for model, pks in required.iteritems())
+    # the operations of each row still standing, from newest to oldest
+    standing = group_by(lambda op: (op.row_id, op.content_type_id), remaining)
+    for operation in remaining:
         model = operation.tracked_model
         if not model:
             logger.error(
                 "operation linked to content type "
                 "not tracked: %s" % operation.content_type_id)
             continue
+        seq = standing[(operation.row_id, operation.content_type_id)]
         if operation.command in ('i', 'u'):
-            if query_model(session, model, only_pk=True).\
-                    filter_by(**{get_pk(model): operation.row_id}).count() == 0:
+            if operation.row_id not in existing[model]:
                 logger.warning(
                     "deleting operation %s for model %s "
                     "for absence of backing object" % (operation, model.__name__))
-                session.delete(operation)
+                deleted.add(operation)
+                seq.remove(operation)
                 continue
         if operation.command == 'u':
-            subsequent = session.query(Operation).\
-                filter(Operation.content_type_id == operation.content_type_id,
-                       Operation.version_id == None,
-                       Operation.row_id == operation.row_id,
-                       Operation.order > operation.order).all()
+            subsequent = [op for op in seq if op.order > operation.order]
             if any(op.command == 'i' for op in subsequent) and \
                     all(op.command != 'd' for op in subsequent):
                 logger.warning(
                     "deleting update operation %s for model %s "
                     "for preceding an insert operation" %\
                         (operation, model.__name__))
-                session.delete(operation)
+                deleted.add(operation)
+                seq.remove(operation)
                 continue
-        if session.query(Operation).\
-                filter(Operation.content_type_id == operation.content_type_id,
-                       Operation.command == operation.command,
-                       Operation.version_id == None,
-                       Operation.row_id == operation.row_id,
-                       Operation.order != operation.order).count() > 0:
+        if any(op.command == operation.command and op is not operation
+               for op in seq):
             logger.warning(
                 "deleting operation %s for model %s "
                 "for being redundant after compression" %\
                     (operation, model.__name__))
-            session.delete(operation)
+            deleted.add(operation)
+            seq.remove(operation)
             continue
-    return session.query(Operation).\
+    return deleted
+
+
+@core.session_committing
+def compress(session=None):
+    """
+    Compresses unversioned operations in the database.
+
+    For each row in the operations table, this deletes unnecesary
+    operations that would otherwise bloat the message.
+
+    This procedure is called internally before the 'push' request
+    happens, and before the local 'merge' happens.
+
+    The operations are loaded with a single query and processed in
+    memory, querying once for each tracked model to check which
+    objects still exist.
+    """
+    unversioned = session.query(Operation).\
         filter(Operation.version_id == None).\
-        order_by(Operation.order.asc()).all()
+        order_by(Operation.order.desc()).all()
+    deleted = _redundant_operations(unversioned, session)
+    map(session.delete, deleted)
+    session.flush()
+    return [op for op in reversed(unversioned) if op not in deleted]
+
+
+def _update_copy(op, changed_columns):
+    """
+    Returns an update like *op* with *changed_columns*, of the same
+    type as *op*, be it Operation or a lightweight record from a
+    message.
+    """
+    if op.command == 'u' and op.changed_columns == changed_columns:
+        return op
+    return type(op)(order=op.order,
+                    content_type_id=op.content_type_id,
+                    row_id=op.row_id,
+                    version_id=op.version_id,
+                    command='u',
+                    changed_columns=changed_columns)
 
 
 def compressed_operations(operations):
@@ -151,36 +215,45 @@ def compressed_operations(operations):
                     sorted(operations, key=attr('order')))
     compressed = []
     for seq in seqs.itervalues():
+        first, last = seq[0], seq[-1]
         if len(seq) == 1:
-            compressed.append(seq[0])
-        elif seq[0].command == 'i':
-            if seq[-1].command == 'd':
-                pass
+            compressed.append(first)
+        elif first.command == 'i':
+            if last.command != 'd':
+                compressed.append(first)
+        elif first.command == 'u':
+            if last.command == 'd':
+                compressed.append(last)
             else:
-                compressed.append(seq[0])
-        elif seq[0].command == 'u':
-            if seq[-1].command == 'd':
-                compressed.append(seq[-1])
+                compressed.append(_update_copy(first, merged_changes(seq)))
+        else: # first.command == 'd':
+            # the object was inserted again, so updates change the
+            # whole row
+            if last.command == 'd':
+                compressed.append(first)
             else:
-                compressed.append(seq[0])
-        else: # seq[0].command == 'd':
-            if seq[-1].command == 'd':
-                compressed.append(seq[0])
-            elif seq[-1].command == 'u':
-                compressed.append(seq[-1])
-            else: # seq[-1].command == 'i':
-                op = seq[-1]
-                compressed.append(
-                    Operation(order=op.order,
-                              content_type_id=op.content_type_id,
-                              row_id=op.row_id,
-                              version_id=op.version_id,
-                              command='u'))
+                compressed.append(_update_copy(last, None))
     compressed.sort(key=attr('order'))
     return compressed
 
 
-@core.session_committing
+def pending_operations(session):
+    """
+    Returns the unversioned operations as they would be left by
+    ``compress``, without modifying the database. The operations are
+    read with a single query, as records, and compressed in memory
+    with the same rules.
+    """
+    table = Operation.__table__
+    unversioned = [OperationRecord.from_dict(dict(row))
+                   for row in session.execute(
+            select([table]).where(table.c.version_id == None).\
+                order_by(table.c.order.desc()))]
+    deleted = _redundant_operations(unversioned, session)
+    return [op for op in reversed(unversioned) if op not in deleted]
+
+
+@core.session_closing
 def unsynched_objects(session=None):
     """
     Returns a list of triads (class, id, operation) that represents
@@ -198,8 +271,11 @@ def unsynched_objects(session=None):
 
     Because of compatibility issues, this procedure will only return
     triads for classes marked for both push and pull handling.
+
+    The operations log isn't modified (see ``pending_operations``), so
+    this can be polled without contending with the application.
     """
-    ops = compress(session=session)
+    ops = pending_operations(session)
     def getclass(op):
         class_ = op.tracked_model
         if class_ is None: return None
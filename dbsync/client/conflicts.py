@@ -92,17 +92,31 @@ def related_remote_ids(operation, container):
         [(synched_models.tables.get(t.name, null_model).model,
           get_fks(t, class_mapper(parent_model).mapped_table))
          for t in related_tables])
+    # the lookups go through the foreign key indexes of the container,
+    # which are built once and reused for every operation
     return set(
         (pk, ct.id)
         for pk, ct in \
-            ((getattr(obj, get_pk(obj)), synched_models.models.get(model, None))
+            ((pk, synched_models.models.get(model, None))
              for model, fks in mapped_fks
-             for obj in container.query(model).\
-                 filter(lambda obj: any(getattr(obj, fk) == operation.row_id
-                                        for fk in fks)))
+             for fk in fks
+             for pk in container.query(model).\
+                 filter(attr(fk) == operation.row_id).pks())
         if ct is not None)
 
 
+def _index_by_row(operations, commands):
+    """
+    Maps (row_id, content_type_id) pairs to the list of *operations*
+    with one of the given *commands* on that row, in the given order.
+    """
+    index = {}
+    for op in operations:
+        if op.command in commands:
+            index.setdefault((op.row_id, op.content_type_id), []).append(op)
+    return index
+
+
 def find_direct_conflicts(pull_ops, unversioned_ops):
     """
     Detect conflicts where there's both unversioned and pulled
@@ -110,14 +124,13 @@ def find_direct_conflicts(pull_ops, unversioned_ops):
     object. This procedure relies on the uniqueness of the primary
     keys through time.
     """
+    local_index = _index_by_row(unversioned_ops, ('u', 'd'))
     return [
         (pull_op, local_op)
         for pull_op in pull_ops
         if pull_op.command == 'u' or pull_op.command == 'd'
-        for local_op in unversioned_ops
-        if local_op.command == 'u' or local_op.command == 'd'
-        if pull_op.row_id == local_op.row_id
-        if pull_op.content_type_id == local_op.content_type_id]
+        for local_op in local_index.get(
+            (pull_op.row_id, pull_op.content_type_id), ())]
 
 
 def find_dependency_conflicts(pull_ops, unversioned_ops, session):
@@ -165,14 +178,13 @@ def find_insert_conflicts(pull_ops, unversioned_ops):
     however, to specify a custom handler for cases where the primary
     key is a meaningful property of the object.
     """
+    pull_index = _index_by_row(pull_ops, ('i',))
     return [
         (pull_op, local_op)
         for local_op in unversioned_ops
         if local_op.command == 'i'
-        for pull_op in pull_ops
-        if pull_op.command == 'i'
-        if pull_op.row_id == local_op.row_id
-        if pull_op.content_type_id == local_op.content_type_id]
+        for pull_op in pull_index.get(
+            (local_op.row_id, local_op.content_type_id), ())]
 
 
 def find_unique_conflicts(pull_ops, unversioned_ops, pull_message, session):
@@ -211,7 +223,7 @@ def find_unique_conflicts(pull_ops, unversioned_ops, pull_message, session):
         Gets the conflicting values out of the remote object set
         (*container*).
         """
-        obj = pull_message.query(model).filter(attr('__pk__') == row_id).first()
+        obj = pull_message.query(model).get(row_id)
         if obj is not None:
             return tuple(getattr(obj, column) for column in columns)
         return (None,)
@@ -254,8 +266,7 @@ def find_unique_conflicts(pull_ops, unversioned_ops, pull_message, session):
                 continue
 
             # if pk_conflict != op.row_id:
-            remote_obj = pull_message.query(model).\
-                filter(attr('__pk__') == pk_conflict).first()
+            remote_obj = pull_message.query(model).get(pk_conflict)
 
             if remote_obj is not None and not is_unversioned:
                 old_values = tuple(getattr(obj_conflict, column)
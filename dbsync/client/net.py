@@ -4,16 +4,21 @@ Send HTTP requests and interpret responses.
 The body returned by each procedure will be a python dictionary
 obtained from parsing a response through a decoder, or ``None`` if the
 decoder raises a ``ValueError``. The default encoder, decoder and
-headers are meant to work with the JSON specification.
+headers are meant to work with the JSON specification. Responses sent
+with the binary content type (see dbsync.messages.binary) are decoded
+with the binary codec instead, regardless of the decoder given, and
+their bodies are told apart with ``decoded_native``.
 
 These procedures will raise a NetworkError in case of network failure.
 """
 
 import requests
-import cStringIO
+import tempfile
 import inspect
 import json
 
+from dbsync.messages import binary
+
 
 class NetworkError(Exception):
     pass
@@ -28,6 +33,16 @@ default_headers = {"Content-Type": "application/json",
 
 default_timeout = 10
 
+#: Size in bytes above which bodies for streaming decoders are spooled
+#  to disk while they're received, instead of being held in memory.
+spool_size = 1024 * 1024
+
+#: Decoders that read from a file value by value, mapped to their
+#  string counterparts. Bodies for other decoders (JSON included, since
+#  ``json.load`` reads the whole file into a string anyway) aren't
+#  spooled, and are decoded from a string.
+stream_decoders = {binary.loads: binary.load}
+
 authentication_callback = None
 
 
@@ -49,6 +64,102 @@ def _defaults(encode, decode, headers, timeout):
     return (e, d, h, t)
 
 
+def encodes_native(encode=None):
+    """
+    Whether messages sent with *encode* (or the default encoder) should
+    be built with native values, since the encoder is the binary
+    codec.
+    """
+    return (encode if encode is not None else default_encoder) is \
+        binary.dumps
+
+
+class NativeBody(dict):
+    """
+    Body of a response sent with the binary content type, which holds
+    python values instead of JSON-friendly ones.
+    """
+
+
+def decoded_native(body):
+    """
+    Whether *body*, as returned by the requests of this module, was
+    sent with the binary codec, and so should be decoded into messages
+    with the *native* flag.
+    """
+    return isinstance(body, NativeBody)
+
+
+def _decoder_for(r, dec):
+    "Picks the decoder for the response *r* based on its content type."
+    if r.headers.get('content-type', "").startswith(binary.CONTENT_TYPE):
+        return binary.loads
+    return dec
+
+
+def _received(r, monitor=None):
+    """
+    Yields the chunks of the body of the response *r* as they're
+    received, reporting each one to *monitor*.
+    """
+    total = r.headers.get('content-length', None)
+    partial = 0
+    for chunk in r.iter_content(chunk_size=64 * 1024):
+        partial += len(chunk)
+        if monitor:
+            monitor({'status': "downloading",
+                     'size': total, 'received': partial})
+        yield chunk
+
+
+def _spool(r, monitor=None):
+    """
+    Receives the body of the response *r* into a spooled file, which
+    moves to disk once it grows past ``spool_size``, and returns it
+    positioned at the start.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    for chunk in _received(r, monitor):
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+def _read_body(r, dec, monitor=None):
+    """
+    Receives the body of the response *r* and decodes it.
+
+    Only bodies for streaming decoders (see ``stream_decoders``) are
+    received into a spooled file and decoded from there value by
+    value. Other bodies, JSON included, are decoded from a single
+    string: the content of the response, or the chunks reported to the
+    *monitor* joined once received.
+
+    Returns ``None`` if the decoder raises a ``ValueError``.
+    """
+    if monitor:
+        monitor({'status': "connect",
+                 'size': r.headers.get('content-length', None)})
+    dec = _decoder_for(r, dec)
+    load = stream_decoders.get(dec, None)
+    try:
+        if load is not None:
+            spool = _spool(r, monitor)
+            try:
+                decoded = load(spool)
+            finally:
+                spool.close()
+        elif monitor:
+            decoded = dec("".join(_received(r, monitor)))
+        else:
+            decoded = dec(r.content)
+    except ValueError:
+        return None
+    if dec is binary.loads and isinstance(decoded, dict):
+        return NativeBody(decoded)
+    return decoded
+
+
 def post_request(server_url, json_dict,
                  encode=None, decode=None, headers=None, timeout=None,
                  monitor=None):
@@ -78,44 +189,25 @@ def post_request(server_url, json_dict,
             not server_url.startswith("https://"):
         server_url = "http://" + server_url
     enc, dec, hhs, tout = _defaults(encode, decode, headers, timeout)
-    stream = inspect.isroutine(monitor)
+    monitored = inspect.isroutine(monitor)
     auth = authentication_callback(server_url) \
         if authentication_callback is not None else None
     try:
         r = requests.post(server_url, data=enc(json_dict),
-                          headers=hhs or None, stream=stream,
+                          headers=hhs or None, stream=True,
                           timeout=tout, auth=auth)
-        response = None
-        if stream:
-            total = r.headers.get('content-length', None)
-            partial = 0
-            monitor({'status': "connect", 'size': total})
-            chunks = cStringIO.StringIO()
-            for chunk in r:
-                partial += len(chunk)
-                monitor({'status': "downloading",
-                         'size': total, 'received': partial})
-                chunks.write(chunk)
-            response = chunks.getvalue()
-            chunks.close()
-        else:
-            response = r.content
-        body = None
-        try:
-            body = dec(response)
-        except ValueError:
-            pass
+        body = _read_body(r, dec, monitor if monitored else None)
         result = (r.status_code, r.reason, body)
         r.close()
         return result
 
     except requests.exceptions.RequestException as e:
-        if stream:
+        if monitored:
             monitor({'status': "error", 'reason': "network error"})
         raise NetworkError(*e.args)
 
     except Exception as e:
-        if stream:
+        if monitored:
             monitor({'status': "error", 'reason': "network error"})
         raise NetworkError(*e.args)
 
@@ -135,44 +227,25 @@ def get_request(server_url, data=None,
             not server_url.startswith("https://"):
         server_url = "http://" + server_url
     enc, dec, hhs, tout = _defaults(encode, decode, headers, timeout)
-    stream = inspect.isroutine(monitor)
+    monitored = inspect.isroutine(monitor)
     auth = authentication_callback(server_url) \
         if authentication_callback is not None else None
     try:
         r = requests.get(server_url, params=data,
-                         headers=hhs or None, stream=stream,
+                         headers=hhs or None, stream=True,
                          timeout=tout, auth=auth)
-        response = None
-        if stream:
-            total = r.headers.get('content-length', None)
-            partial = 0
-            monitor({'status': "connect", 'size': total})
-            chunks = cStringIO.StringIO()
-            for chunk in r:
-                partial += len(chunk)
-                monitor({'status': "downloading",
-                         'size': total, 'received': partial})
-                chunks.write(chunk)
-            response = chunks.getvalue()
-            chunks.close()
-        else:
-            response = r.content
-        body = None
-        try:
-            body = dec(response)
-        except ValueError:
-            pass
+        body = _read_body(r, dec, monitor if monitored else None)
         result = (r.status_code, r.reason, body)
         r.close()
         return result
 
     except requests.exceptions.RequestException as e:
-        if stream:
+        if monitored:
             monitor({'status': "error", 'reason': "network error"})
         raise NetworkError(*e.args)
 
     except Exception as e:
-        if stream:
+        if monitored:
             monitor({'status': "error", 'reason': "network error"})
         raise NetworkError(*e.args)
 
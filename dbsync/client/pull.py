@@ -11,6 +11,7 @@ from dbsync.utils import class_mapper, get_pk, query_model
 from dbsync import core
 from dbsync.models import Operation
 from dbsync import dialects
+from dbsync.messages.base import PayloadError
 from dbsync.messages.pull import PullMessage, PullRequestMessage
 from dbsync.client.compression import compress, compressed_operations
 from dbsync.client.conflicts import (
@@ -21,7 +22,7 @@ from dbsync.client.conflicts import (
     find_reversed_dependency_conflicts,
     find_insert_conflicts,
     find_unique_conflicts)
-from dbsync.client.net import post_request
+from dbsync.client.net import post_request, encodes_native, decoded_native
 
 
 # Utilities specific to the merge
@@ -41,7 +42,7 @@ def max_remote(model, container):
     Returns the maximum value for the primary key of the given model
     in the container.
     """
-    return max(getattr(obj, get_pk(obj)) for obj in container.query(model))
+    return max(container.query(model).pks())
 
 
 def update_local_id(old_id, new_id, model, session):
@@ -235,7 +236,7 @@ def merge(pull_message, session=None):
 
     # IV) fourth phase: insert versions from the pull_message
     for pull_version in pull_message.versions:
-        session.add(pull_version)
+        session.add(pull_version.to_model())
 
 
 class BadResponseError(Exception):
@@ -260,7 +261,12 @@ def pull(pull_url, extra_data=None,
     headers for JSON.
 
     *monitor* should be a routine that receives a dictionary with
-    information of the state of the request and merge procedure.
+    information of the state of the request and merge procedure. The
+    'merging' state includes the per-model counters of the message
+    under 'stats' (see dbsync.messages.base.BaseMessage.stats),
+    without the 'bytes' counter. Sizes aren't measured, since that
+    would load the whole payload before the merge; the size of the
+    response is reported in the 'downloading' states.
 
     *include_extensions* dictates whether the extension functions will
     be called during the merge or not. Default is ``True``.
@@ -271,8 +277,10 @@ def pull(pull_url, extra_data=None,
         assert isinstance(extra_data, dict), "extra data must be a dictionary"
     request_message = PullRequestMessage()
     for op in compress(): request_message.add_operation(op)
-    data = request_message.to_json()
-    data.update({'extra_data': extra_data or {}})
+    data = request_message.to_json(native=encodes_native(encode))
+    # servers that don't know the columnar format ignore the request
+    data.update({'extra_data': extra_data or {},
+                 'payload_format': 'columns'})
 
     code, reason, response = post_request(
         pull_url, data, encode, decode, headers, timeout, monitor)
@@ -288,7 +296,7 @@ def pull(pull_url, extra_data=None,
         raise BadResponseError(code, reason, response)
     message = None
     try:
-        message = PullMessage(response)
+        message = PullMessage(response, decoded_native(response))
     except KeyError:
         if monitor:
             monitor({
@@ -300,8 +308,17 @@ def pull(pull_url, extra_data=None,
     if monitor:
         monitor({
             'status': "merging",
-            'operations': len(message.operations)})
-    merge(message, include_extensions=include_extensions)
+            'operations': len(message.operations),
+            'stats': message.stats})
+    try:
+        merge(message, include_extensions=include_extensions)
+    except PayloadError as e:
+        if monitor:
+            monitor({
+                'status': "error",
+                'reason': "invalid message format"})
+        raise BadResponseError(
+            "response object isn't a valid PullMessage", *e.args)
     if monitor:
         monitor({'status': "done"})
     # return the response for the programmer to do what she wants
@@ -9,7 +9,7 @@ from dbsync import core
 from dbsync.models import Node, Version
 from dbsync.messages.push import PushMessage
 from dbsync.client.compression import compress
-from dbsync.client.net import post_request
+from dbsync.client.net import post_request, encodes_native
 
 
 class PushRejected(Exception): pass
@@ -26,6 +26,7 @@ def request_push(push_url,
                  extra_data=None,
                  encode=None, decode=None, headers=None, timeout=None,
                  extensions=True,
+                 payload_format='rows',
                  session=None):
     message = PushMessage()
     message.latest_version_id = core.get_latest_version_id(session=session)
@@ -34,7 +35,7 @@ def request_push(push_url,
         session=session, include_extensions=extensions)
     message.set_node(session.query(Node).order_by(Node.node_id.desc()).first())
 
-    data = message.to_json()
+    data = message.to_json(payload_format, encodes_native(encode))
     data.update({'extra_data': extra_data or {}})
 
     code, reason, response = post_request(
@@ -64,7 +65,7 @@ def request_push(push_url,
 
 def push(push_url, extra_data=None,
          encode=None, decode=None, headers=None, timeout=None,
-         include_extensions=True):
+         include_extensions=True, payload_format='rows'):
     """
     Attempts a push to the server. Returns the response body.
 
@@ -84,6 +85,11 @@ def push(push_url, extra_data=None,
 
     *include_extensions* dictates whether the message will include
     model extensions or not.
+
+    *payload_format* is the format used to encode the objects in the
+    message (see dbsync.messages.base.payload_formats). The 'columns'
+    format is smaller, but servers running older versions of the
+    library can't decode it. Default is 'rows'.
     """
     assert isinstance(push_url, basestring), "push url must be a string"
     assert bool(push_url), "push url can't be empty"
@@ -95,4 +101,5 @@ def push(push_url, extra_data=None,
         extra_data=extra_data,
         encode=encode, decode=decode, headers=headers, timeout=timeout,
         extensions=include_extensions,
+        payload_format=payload_format,
         include_extensions=include_extensions)
@@ -9,7 +9,7 @@ layer on the server.
 from dbsync import core
 from dbsync.models import Node
 from dbsync.messages.register import RegisterMessage
-from dbsync.client.net import post_request
+from dbsync.client.net import post_request, decoded_native
 
 
 class RegisterRejected(Exception): pass
@@ -42,7 +42,7 @@ def register(registry_url, extra_data=None,
     if (code // 100 != 2) or response is None:
         raise RegisterRejected(code, reason, response)
 
-    message = RegisterMessage(response)
+    message = RegisterMessage(response, decoded_native(response))
     session.add(message.node)
     return response
 
@@ -17,8 +17,8 @@ client database and fetches a big message from the server.
 
 from dbsync import core
 from dbsync.models import Operation, Version
-from dbsync.messages.base import BaseMessage
-from dbsync.client.net import get_request
+from dbsync.messages.base import BaseMessage, PayloadError
+from dbsync.client.net import get_request, decoded_native
 
 
 @core.with_transaction()
@@ -61,6 +61,10 @@ def repair(repair_url, include_extensions=True, extra_data=None,
 
     *extra_data* can be used to add user credentials.
 
+    *monitor* works as in dbsync.client.pull.pull. The 'repairing'
+    state includes the per-model counters of the message under
+    'stats', without the 'bytes' counter.
+
     By default, the *encode* function is ``json.dumps``, the *decode*
     function is ``json.loads``, and the *headers* are appropriate HTTP
     headers for JSON.
@@ -70,7 +74,9 @@ def repair(repair_url, include_extensions=True, extra_data=None,
     if extra_data is not None:
         assert isinstance(extra_data, dict), "extra data must be a dictionary"
         assert 'exclude_extensions' not in extra_data, "reserved request key"
+        assert 'payload_format' not in extra_data, "reserved request key"
     data = {'exclude_extensions': ""} if not include_extensions else {}
+    data['payload_format'] = 'columns'
     data.update(extra_data or {})
 
     code, reason, response = get_request(
@@ -85,17 +91,24 @@ def repair(repair_url, include_extensions=True, extra_data=None,
         raise BadResponseError(code, reason, response)
     message = None
     try:
-        message = BaseMessage(response)
+        message = BaseMessage(response, decoded_native(response))
     except KeyError:
         if monitor: monitor({'status': "error",
                              'reason': "invalid message format"})
         raise BadResponseError(
             "response object isn't a valid BaseMessage", response)
 
-    if monitor: monitor({'status': "repairing"})
-    repair_database(
-        message,
-        response.get("latest_version_id", None),
-        include_extensions=include_extensions)
+    if monitor: monitor({'status': "repairing",
+                         'stats': message.stats})
+    try:
+        repair_database(
+            message,
+            response.get("latest_version_id", None),
+            include_extensions=include_extensions)
+    except PayloadError as e:
+        if monitor: monitor({'status': "error",
+                             'reason': "invalid message format"})
+        raise BadResponseError(
+            "response object isn't a valid BaseMessage", *e.args)
     if monitor: monitor({'status': "done"})
     return response
@@ -6,8 +6,8 @@ together by ``and_`` in the server.
 """
 
 from dbsync import core
-from dbsync.messages.base import BaseMessage
-from dbsync.client.net import get_request
+from dbsync.messages.base import BaseMessage, PayloadError
+from dbsync.client.net import get_request, decoded_native
 
 
 class BadResponseError(Exception): pass
@@ -21,7 +21,7 @@ def query_server(query_url,
     This procedure returns a procedure that receives the class and
     filters, and performs the HTTP request."""
     def query(cls, **args):
-        data = {'model': cls.__name__}
+        data = {'model': cls.__name__, 'payload_format': 'columns'}
         data.update(dict(('{0}_{1}'.format(cls.__name__, key), value)
                          for key, value in args.iteritems()))
 
@@ -35,13 +35,12 @@ def query_server(query_url,
             if monitor: monitor({'status': "error",
                                  'reason': "invalid response format"})
             raise BadResponseError(code, reason, response)
-        message = None
         try:
-            message = BaseMessage(response)
-        except KeyError:
+            return BaseMessage(response, decoded_native(response)).\
+                query(cls).all()
+        except (KeyError, PayloadError):
             if monitor: monitor({'status': "error",
                                  'reason': "invalid message format"})
             raise BadResponseError(
                 "response object isn't a valid BaseMessage", response)
-        return message.query(cls).all()
     return query
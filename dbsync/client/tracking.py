@@ -5,13 +5,19 @@ Listeners to SQLAlchemy events to keep track of CUD operations.
 import logging
 import inspect
 import warnings
+import weakref
 from collections import deque
 
-from sqlalchemy import event
+from sqlalchemy import event, select, and_, tuple_
+from sqlalchemy.orm import Query
+from sqlalchemy.orm.attributes import get_history
 from sqlalchemy.orm.session import Session as GlobalSession
 
-from dbsync import core
+from dbsync.lang import *
+from dbsync import core, dialects
 from dbsync.models import Operation
+from dbsync.messages.records import OperationRecord
+from dbsync.client.compression import merged_changes
 from dbsync.logs import get_logger
 
 
@@ -23,50 +29,216 @@ if core.mode == 'server':
 core.mode = 'client'
 
 
-#: Operations to be flushed to the database after a commit.
-_operations_queue = deque()
+#: Models whose operations are tracked through this module, those
+#  marked for push. The bulk listeners hang off the global Query
+#  class, as those of the server do, so they check this set instead of
+#  the registries shared in core.
+tracked_models = set()
+
+
+#: Operations to be flushed to the database after a commit, queued
+#  separately for each session, so that sessions in different threads
+#  don't write or discard each other's operations.
+_operations_queues = weakref.WeakKeyDictionary()
+
+
+def operations_queue(session):
+    "Returns the queue of operations of *session*."
+    queue = _operations_queues.get(session, None)
+    if queue is None:
+        queue = _operations_queues[session] = deque()
+    return queue
+
+
+#: Ways of writing the captured operations to the database. With
+#  'after_commit', operations are added in a separate transaction
+#  after each commit of the application. With 'in_transaction', they
+#  are inserted in bulk after each flush, through the connection of
+#  the flushing session, so they're committed or rolled back along
+#  with the changes that produced them. With 'triggers', database
+#  triggers register the operations instead of the ORM listeners (see
+#  ``install_triggers``).
+capture_modes = ('after_commit', 'in_transaction', 'triggers')
+
+#: The capture mode in use, one of ``capture_modes``.
+capture_mode = 'after_commit'
+
+#: Whether captured operations are coalesced with the unversioned
+#  operation of the same row as they're written, instead of appended
+#  to the log. Applies to the 'after_commit' and 'in_transaction'
+#  capture modes.
+coalescing = False
+
+
+def insert_operations(session, flush_context):
+    """
+    Inserts the queued operations with a single executemany in the
+    transaction of *session*, if the 'in_transaction' capture mode is
+    in use.
+    """
+    queue = _operations_queues.get(session, None)
+    if capture_mode != 'in_transaction' or not queue or \
+            getattr(session, core.INTERNAL_SESSION_ATTR, False):
+        return
+    if not core.is_listening(session):
+        logger.warning("dbsync is disabled; aborting insert_operations")
+        return
+    _write_queue(session, queue)
+
+
+def _row(op):
+    "Returns the values of *op* for an insert statement."
+    return {'row_id': op.row_id,
+            'version_id': op.version_id,
+            'content_type_id': op.content_type_id,
+            'command': op.command,
+            'changed_columns': op.changed_columns}
+
+
+def _newest_unversioned(connection, keys):
+    """
+    Returns the newest unversioned operation of each row in *keys*, a
+    sequence of (content_type_id, row_id) pairs, mapped to its pair.
+    The operations are read with a single query for each batch of
+    rows.
+    """
+    table = Operation.__table__
+    row = tuple_(table.c.content_type_id, table.c.row_id)
+    newest = {}
+    # each pair takes two variables
+    for batch in grouper(keys, core.MAX_SQL_VARIABLES // 2):
+        for op in connection.execute(
+                select([table.c.order,
+                        table.c.content_type_id,
+                        table.c.row_id,
+                        table.c.command,
+                        table.c.changed_columns]).\
+                    where(and_(row.in_(list(batch)),
+                               table.c.version_id == None)).\
+                    order_by(table.c.order)):
+            newest[(op.content_type_id, op.row_id)] = op
+    return newest
+
+
+def _coalesce(connection, ops):
+    """
+    Writes the operations *ops* merged with the newest unversioned
+    operation of the same row, following the compression rules, so that
+    the log holds a single unversioned operation for each dirty row.
+
+    The newest operations of the rows are read in batches and merged
+    with *ops* in memory, then replaced with a single DELETE and a
+    single executemany INSERT.
+    """
+    table = Operation.__table__
+    keys = [(op.content_type_id, op.row_id) for op in ops]
+    previous = _newest_unversioned(connection, list(set(keys)))
+    # the operation left for each changed row, or None to leave none,
+    # and the position of its last change
+    merged = dict(previous)
+    changed = {}
+    for position, (key, op) in enumerate(izip(keys, ops)):
+        last = merged.get(key, None)
+        command, columns = op.command, op.changed_columns
+        if last is not None:
+            pair = (last.command, op.command)
+            if pair == ('i', 'u'):
+                continue # the insert already sends the whole row
+            if pair == ('i', 'd'):
+                # as if the row never existed
+                merged[key] = None
+                changed[key] = position
+                continue
+            if pair == ('u', 'u'):
+                columns = merged_changes([last, op])
+            elif pair == ('d', 'i'):
+                command, columns = 'u', None
+        merged[key] = OperationRecord(row_id=op.row_id,
+                                      version_id=op.version_id,
+                                      content_type_id=op.content_type_id,
+                                      command=command,
+                                      changed_columns=columns)
+        changed[key] = position
+    replaced = [previous[key].order for key in changed if key in previous]
+    for batch in grouper(replaced, core.MAX_SQL_VARIABLES):
+        connection.execute(table.delete().where(table.c.order.in_(list(batch))))
+    rows = [_row(merged[key]) for key in sorted(changed, key=changed.get)
+            if merged[key] is not None]
+    if rows:
+        connection.execute(table.insert(), rows)
+
+
+def _write_queue(session, queue):
+    "Inserts the operations in *queue* through the connection of *session*."
+    connection = session.connection()
+    ops = []
+    while queue:
+        ops.append(queue.popleft())
+    if coalescing:
+        _coalesce(connection, ops)
+    elif ops:
+        connection.execute(Operation.__table__.insert(), map(_row, ops))
 
 
 def flush_operations(committed_session):
     "Flush operations after a commit has been issued."
-    if not _operations_queue or \
+    queue = _operations_queues.get(committed_session, None)
+    if not queue or \
             getattr(committed_session, core.INTERNAL_SESSION_ATTR, False):
         return
-    if not core.listening:
+    if not core.is_listening(committed_session):
         logger.warning("dbsync is disabled; aborting flush_operations")
         return
     with core.committing_context() as session:
-        while _operations_queue:
-            op = _operations_queue.popleft()
+        if coalescing:
+            _write_queue(session, queue)
+        while queue:
+            op = queue.popleft()
             session.add(op)
             session.flush()
 
 
 def empty_queue(*args):
-    "Empty the operations queue."
+    "Empty the operations queue of the session given, or every queue."
     session = None if not args else args[0]
     if getattr(session, core.INTERNAL_SESSION_ATTR, False):
         return
-    if not core.listening:
+    if not core.is_listening(session):
         logger.warning("dbsync is disabled; aborting empty_queue")
         return
-    while _operations_queue:
-        _operations_queue.pop()
+    if session is None:
+        _operations_queues.clear()
+        return
+    queue = _operations_queues.get(session, None)
+    while queue:
+        queue.pop()
+
+
+def changed_columns(mapper, target):
+    """
+    Returns the comma-separated names of the columns of *target* that
+    changed since it was loaded, according to the attribute history,
+    or ``None`` if none did (e.g. when only collections changed).
+    """
+    changed = [prop.key for prop in mapper.column_attrs
+               if get_history(target, prop.key).has_changes()]
+    return ",".join(sorted(changed)) if changed else None
 
 
 def make_listener(command):
     "Builds a listener for the given command (i, u, d)."
     def listener(mapper, connection, target):
-        if getattr(core.SessionClass.object_session(target),
-                   core.INTERNAL_SESSION_ATTR,
-                   False):
+        if capture_mode == 'triggers':
             return
-        if not core.listening:
+        session = core.SessionClass.object_session(target)
+        if getattr(session, core.INTERNAL_SESSION_ATTR, False):
+            return
+        if not core.is_listening(session):
             logger.warning("dbsync is disabled; "
                            "aborting listener to '{0}' command".format(command))
             return
-        if command == 'u' and not core.SessionClass.object_session(target).\
-                is_modified(target, include_collections=False):
+        if command == 'u' and \
+                not session.is_modified(target, include_collections=False):
             return
         tname = mapper.mapped_table.name
         if tname not in core.synched_models.tables:
@@ -78,8 +250,42 @@ def make_listener(command):
             row_id=pk,
             version_id=None, # operation not yet versioned
             content_type_id=core.synched_models.tables[tname].id,
-            command=command)
-        _operations_queue.append(op)
+            command=command,
+            changed_columns=changed_columns(mapper, target) \
+                if command == 'u' else None)
+        operations_queue(session).append(op)
+    return listener
+
+
+def make_bulk_listener(command):
+    """
+    Builds a listener for bulk updates or deletes (*command* 'u' or
+    'd') issued through ``Query.update`` and ``Query.delete``. It
+    registers an operation for each row matched by the query with a
+    single INSERT ... SELECT, in the transaction of the query, before
+    the statement is executed.
+    """
+    def listener(query, context):
+        session = query.session
+        if capture_mode == 'triggers' or \
+                getattr(session, core.INTERNAL_SESSION_ATTR, False) or \
+                context.mapper is None or \
+                context.mapper.class_ not in tracked_models:
+            return
+        if not core.is_listening(session):
+            logger.warning("dbsync is disabled; "
+                           "aborting bulk listener to '{0}' command".\
+                               format(command))
+            return
+        statement = core.bulk_operations(query, context.mapper, command)
+        if statement is None:
+            return
+        # operations queued earlier in the session go first, to keep
+        # the order
+        queue = _operations_queues.get(session, None)
+        if queue:
+            _write_queue(session, queue)
+        session.connection().execute(statement)
     return listener
 
 
@@ -88,11 +294,15 @@ def _start_tracking(model, directions):
         core.pulled_models.add(model)
     if 'push' in directions:
         core.pushed_models.add(model)
+        tracked_models.add(model)
     if model in core.synched_models.models:
         return model
     core.synched_models.install(model)
     if 'push' not in directions:
         return model # don't track operations for pull-only models
+    if capture_mode == 'triggers':
+        dialects.create_capture_triggers(
+            model, core.synched_models.models[model].id, core.get_engine())
     event.listen(model, 'after_insert', make_listener('i'))
     event.listen(model, 'after_update', make_listener('u'))
     event.listen(model, 'after_delete', make_listener('d'))
@@ -121,5 +331,86 @@ def track(*directions):
     return lambda model: _start_tracking(model, directions)
 
 
+def install_triggers():
+    """
+    Installs the database triggers that register operations for the
+    tracked models, for the 'triggers' capture mode. Triggers capture
+    every write to the tracked tables, including those issued outside
+    the ORM, without running python for each row. They're disabled
+    within the transactions of the library itself. Only SQLite is
+    supported.
+    """
+    engine = core.get_engine()
+    for model in tracked_models:
+        dialects.create_capture_triggers(
+            model, core.synched_models.models[model].id, engine)
+
+
+def uninstall_triggers():
+    "Removes the triggers installed by ``install_triggers``."
+    engine = core.get_engine()
+    for model in tracked_models:
+        dialects.drop_capture_triggers(model, engine)
+
+
+#: Key in ``Session.info`` set while the capture triggers are paused
+#  in the transaction of the session.
+TRIGGERS_PAUSED_INFO_KEY = 'dbsync_triggers_paused'
+
+
+def pause_triggers(session, *args):
+    """
+    Disables the capture triggers for transactions of the library, as
+    they're about to write (before a flush or a bulk statement), so
+    that read-only sessions don't take a write lock.
+    """
+    if capture_mode == 'triggers' and \
+            getattr(session, core.INTERNAL_SESSION_ATTR, False) and \
+            not session.info.get(TRIGGERS_PAUSED_INFO_KEY, False):
+        dialects.set_trigger_capture(False, session.connection())
+        session.info[TRIGGERS_PAUSED_INFO_KEY] = True
+
+
+def pause_triggers_for_query(query, context):
+    pause_triggers(query.session)
+
+
+def resume_triggers(session):
+    """
+    Enables the capture triggers again, at the end of a transaction of
+    the library that paused them. Pending changes are flushed first,
+    so they aren't registered.
+    """
+    if capture_mode == 'triggers' and \
+            getattr(session, core.INTERNAL_SESSION_ATTR, False) and \
+            session.transaction is not None:
+        session.flush()
+        if session.info.pop(TRIGGERS_PAUSED_INFO_KEY, False):
+            dialects.set_trigger_capture(True, session.connection())
+
+
+def restore_paused_triggers(session):
+    """
+    Enables the capture triggers again after a transaction of the
+    library that paused them is rolled back. The pause is usually
+    rolled back with it, but not if the connection wasn't in a
+    transaction, and the connection would then go back to the pool with
+    the triggers off.
+    """
+    if session.info.pop(TRIGGERS_PAUSED_INFO_KEY, False):
+        with session.get_bind().begin() as connection:
+            if not dialects.trigger_capture_enabled(connection):
+                dialects.set_trigger_capture(True, connection)
+
+
+if core.bulk_query_events:
+    event.listen(Query, 'before_compile_update', make_bulk_listener('u'))
+    event.listen(Query, 'before_compile_delete', make_bulk_listener('d'))
+    event.listen(Query, 'before_compile_update', pause_triggers_for_query)
+    event.listen(Query, 'before_compile_delete', pause_triggers_for_query)
+event.listen(GlobalSession, 'before_flush', pause_triggers)
+event.listen(GlobalSession, 'before_commit', resume_triggers)
+event.listen(GlobalSession, 'after_rollback', restore_paused_triggers)
+event.listen(GlobalSession, 'after_flush', insert_operations)
 event.listen(GlobalSession, 'after_commit', flush_operations)
 event.listen(GlobalSession, 'after_soft_rollback', empty_queue)
@@ -4,16 +4,21 @@ Common functionality for model synchronization and version tracking.
 
 import zlib
 import inspect
+import threading
 import contextlib
 import logging
 logging.getLogger('dbsync').addHandler(logging.NullHandler())
 
+from sqlalchemy import sql
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import events as orm_events
 from sqlalchemy.engine import Engine
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import CreateColumn
 
 from dbsync.lang import *
-from dbsync.utils import get_pk, query_model, copy, class_mapper
-from dbsync.models import ContentType, Operation, Version
+from dbsync.utils import get_pk, query_model, copy, class_mapper, EventRegister
+from dbsync.models import Base, ContentType, Operation, Version
 from dbsync import dialects
 from dbsync.logs import get_logger
 
@@ -115,6 +120,29 @@ def get_engine():
     return _engine
 
 
+def upgrade_schema():
+    """
+    Adds the columns missing from internal tables created by previous
+    versions of dbsync. Only nullable columns are added, so existing
+    rows are left untouched.
+    """
+    engine = get_engine()
+    inspector = Inspector.from_engine(engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = set(c['name'] for c in inspector.get_columns(table.name))
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                connection.execute(u"ALTER TABLE {0} ADD COLUMN {1}".format(
+                    preparer.format_table(table),
+                    CreateColumn(column).compile(dialect=engine.dialect)))
+
+
 class tracked_record(object):
 
     def __setattr__(self, *args):
@@ -170,6 +198,11 @@ pushed_models = set()
 model_extensions = {}
 
 
+#: Listeners called with the model and the field name after each
+#  model extension.
+extended = EventRegister()
+
+
 def extend(model, fieldname, fieldtype, loadfn, savefn, deletefn=None):
     """
     Extends *model* with a field of name *fieldname* and type
@@ -209,6 +242,8 @@ def extend(model, fieldname, fieldtype, loadfn, savefn, deletefn=None):
     type_ = fieldtype if not inspect.isclass(fieldtype) else fieldtype()
     extensions[fieldname] = (type_, loadfn, savefn, deletefn)
     model_extensions[model.__name__] = extensions
+    for listener in extended:
+        listener(model, fieldname)
 
 
 def _has_extensions(obj):
@@ -255,6 +290,12 @@ def delete_extensions(old_obj, new_obj):
 #: Toggled variable used to disable listening to operations momentarily.
 listening = True
 
+#: Per-thread listening state, overriding the global one when set.
+_thread_state = threading.local()
+
+#: Key in ``Session.info`` of the per-session listening state.
+LISTENING_INFO_KEY = 'dbsync_listening'
+
 
 def toggle_listening(enabled=None):
     """
@@ -262,26 +303,69 @@ def toggle_listening(enabled=None):
 
     If set to ``False``, no operations will be registered. This can be
     used to disable dbsync temporarily, in scripts or blocks that
-    execute in a single-threaded environment.
+    execute in a single-threaded environment. Use
+    ``set_thread_listening`` or ``set_session_listening`` to limit the
+    change to a thread or a session.
     """
     global listening
     listening = enabled if enabled is not None else not listening
 
 
-def with_listening(enabled):
+def set_thread_listening(enabled):
+    """
+    Sets the listening state for the current thread only. If
+    *enabled* is ``None`` the thread follows the global state again.
+    """
+    _thread_state.listening = enabled
+
+
+def set_session_listening(session, enabled):
+    """
+    Sets the listening state for *session* only, overriding the thread
+    and global states. If *enabled* is ``None`` the session follows
+    those again.
+    """
+    if enabled is None:
+        session.info.pop(LISTENING_INFO_KEY, None)
+    else:
+        session.info[LISTENING_INFO_KEY] = enabled
+
+
+def is_listening(session=None):
+    """
+    Whether operations are being registered for *session*, if given,
+    in the current thread.
+    """
+    if session is not None:
+        enabled = session.info.get(LISTENING_INFO_KEY, None)
+        if enabled is not None:
+            return enabled
+    enabled = getattr(_thread_state, 'listening', None)
+    return enabled if enabled is not None else listening
+
+
+def with_listening(enabled, thread=False):
     """
     Decorator for procedures to be executed with the specified
-    listening status.
+    listening status. If *thread* is ``True`` the status is set for
+    the executing thread only.
     """
     def wrapper(proc):
         @wraps(proc)
         def wrapped(*args, **kwargs):
-            prev = bool(listening)
-            toggle_listening(enabled)
+            if thread:
+                prev = getattr(_thread_state, 'listening', None)
+                set_thread_listening(enabled)
+            else:
+                prev = bool(listening)
+                toggle_listening(enabled)
             try:
                 return proc(*args, **kwargs)
             finally:
-                toggle_listening(prev)
+                if thread:
+                    set_thread_listening(prev)
+                else:
+                    toggle_listening(prev)
         return wrapped
     return wrapper
 
@@ -356,6 +440,34 @@ def with_transaction(include_extensions=True):
     return wrapper
 
 
+#: Whether ``Query.update`` and ``Query.delete`` can be tracked, which
+#  requires the query events added in SQLAlchemy 1.2.17.
+bulk_query_events = hasattr(getattr(orm_events, 'QueryEvents', None),
+                            'before_compile_update')
+
+
+def bulk_operations(query, mapper, command, version_id=None):
+    """
+    Returns an INSERT ... SELECT statement that registers an operation
+    with *command* for each row matched by the criterion of *query*,
+    a query over the mapped class of *mapper* about to be used in a
+    bulk update or delete. Returns ``None`` if the class isn't
+    tracked.
+    """
+    record = synched_models.models.get(mapper.class_, None)
+    if record is None:
+        return None
+    pk = getattr(mapper.class_, get_pk(mapper.class_))
+    select = sql.select(
+        [pk,
+         sql.null() if version_id is None else sql.literal(version_id),
+         sql.literal(record.id),
+         sql.literal(command)],
+        whereclause=query.whereclause)
+    return Operation.__table__.insert().from_select(
+        ['row_id', 'version_id', 'content_type_id', 'command'], select)
+
+
 def make_content_type_id(model):
     "Returns a content type id for the given model."
     mname = model.__name__
@@ -389,15 +501,51 @@ def is_synched(obj, session=None):
     Raises a TypeError if the given object is not being tracked
     (i.e. the content type doesn't exist).
     """
-    if type(obj) not in synched_models.models:
+    status = sync_status([obj], session=session)[obj]
+    if status == 'untracked':
         raise TypeError("the given object of class {0} isn't being tracked".\
                             format(obj.__class__.__name__))
-    session = Session()
-    last_op = session.query(Operation).\
-        filter(Operation.content_type_id == synched_models.models[type(obj)].id,
-               Operation.row_id == getattr(obj, get_pk(obj))).\
-               order_by(Operation.order.desc()).first()
-    return last_op is None or last_op.version_id is not None
+    return status == 'synced'
+
+
+@session_closing
+def sync_status(objects, session=None):
+    """
+    Returns a dictionary mapping each of the given *objects* to its
+    synchronization status: 'synced' if its latest operation is
+    versioned or it has none, 'pending' if it has unversioned
+    operations, or 'untracked' if its class isn't being tracked.
+
+    The operations are fetched with one query for each model (more
+    for models with more than MAX_SQL_VARIABLES objects).
+    """
+    status = {}
+    by_model = {}
+    for obj in objects:
+        model = type(obj)
+        if model not in synched_models.models:
+            status[obj] = 'untracked'
+        else:
+            status[obj] = 'synced'
+            by_model.setdefault(model, []).append(obj)
+    for model, objs in by_model.iteritems():
+        pk_name = get_pk(model)
+        content_type_id = synched_models.models[model].id
+        # the version of the latest operation of each row
+        latest = {}
+        for batch in grouper(set(getattr(obj, pk_name) for obj in objs),
+                             MAX_SQL_VARIABLES):
+            latest.update(session.query(Operation.row_id,
+                                        Operation.version_id).\
+                              filter(Operation.content_type_id == \
+                                         content_type_id,
+                                     Operation.row_id.in_(list(batch))).\
+                              order_by(Operation.order))
+        for obj in objs:
+            pk = getattr(obj, pk_name)
+            if pk in latest and latest[pk] is None:
+                status[obj] = 'pending'
+    return status
 
 
 @session_closing
@@ -6,6 +6,7 @@
 from sqlalchemy import func
 
 from dbsync.utils import class_mapper, get_pk
+from dbsync.models import Operation
 
 
 def begin_transaction(session):
@@ -61,3 +62,81 @@ def max_local(sa_class, session):
         cursor.close()
         return max(result, found)
     return found
+
+
+#: Table holding the switch of the capture triggers, a single row with
+#  a boolean column.
+capture_state_table = "sync_capture_state"
+
+
+def _trigger_name(table_name, command):
+    return "dbsync_capture_{0}_{1}".format(table_name, command)
+
+
+def create_capture_triggers(sa_class, content_type_id, engine):
+    """
+    Installs triggers that register an operation for each insert,
+    update and delete on the table of *sa_class*, while the switch in
+    ``capture_state_table`` is on. Only SQLite is supported.
+    """
+    dialect = engine.name
+    if dialect != 'sqlite':
+        raise NotImplementedError(
+            "capture triggers aren't supported for {0}".format(dialect))
+    table_name = class_mapper(sa_class).mapped_table.name
+    pk = get_pk(sa_class)
+    engine.execute(
+        'CREATE TABLE IF NOT EXISTS "{0}" (enabled INTEGER NOT NULL)'.\
+            format(capture_state_table))
+    engine.execute(
+        'INSERT INTO "{0}" (enabled) SELECT 1 WHERE NOT EXISTS '\
+            '(SELECT 1 FROM "{0}")'.format(capture_state_table))
+    for command, event, row in (('i', 'INSERT', 'NEW'),
+                                ('u', 'UPDATE', 'NEW'),
+                                ('d', 'DELETE', 'OLD')):
+        engine.execute(
+            'CREATE TRIGGER IF NOT EXISTS "{name}" AFTER {event} '\
+                'ON "{table}" '\
+                'WHEN (SELECT enabled FROM "{state}") '\
+                'BEGIN '\
+                'INSERT INTO "{operations}" '\
+                '(row_id, version_id, content_type_id, command) '\
+                'VALUES ({row}."{pk}", NULL, {content_type_id}, \'{command}\'); '\
+                'END'.format(name=_trigger_name(table_name, command),
+                             event=event,
+                             table=table_name,
+                             state=capture_state_table,
+                             operations=Operation.__table__.name,
+                             row=row,
+                             pk=pk,
+                             content_type_id=int(content_type_id),
+                             command=command))
+
+
+def drop_capture_triggers(sa_class, engine):
+    "Removes the triggers installed by ``create_capture_triggers``."
+    if engine.name != 'sqlite':
+        return
+    table_name = class_mapper(sa_class).mapped_table.name
+    for command in ('i', 'u', 'd'):
+        engine.execute('DROP TRIGGER IF EXISTS "{0}"'.format(
+                _trigger_name(table_name, command)))
+
+
+def set_trigger_capture(enabled, connection):
+    """
+    Turns the capture triggers on or off, within the transaction of
+    *connection*.
+    """
+    if connection.engine.name != 'sqlite':
+        return
+    connection.execute('UPDATE "{0}" SET enabled = {1}'.format(
+            capture_state_table, int(bool(enabled))))
+
+
+def trigger_capture_enabled(connection):
+    "Whether the capture triggers are on, as seen by *connection*."
+    if connection.engine.name != 'sqlite':
+        return False
+    return bool(connection.execute('SELECT enabled FROM "{0}"'.format(
+                capture_state_table)).scalar())
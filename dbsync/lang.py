@@ -38,16 +38,24 @@ def partial(f, *arguments):
 
 class Function(object):
     "Composable function for attr and method usage."
-    def __init__(self, fn):
+    def __init__(self, fn, attrname=None):
         self.fn = fn
         self.__name__ = fn.__name__ # e.g. for the wraps decorator
+        #: The attribute read by this function, if built with ``attr``
+        self.attrname = attrname
+        #: A pair (attribute name, value) if this function is an
+        #  equality predicate over an attribute, used for index lookups
+        self.equality = None
     def __call__(self, obj):
         return self.fn(obj)
     def __eq__(self, other):
         if isinstance(other, Function):
             return Function(lambda obj: self.fn(obj) == other(obj))
         else:
-            return Function(lambda obj: self.fn(obj) == other)
+            predicate = Function(lambda obj: self.fn(obj) == other)
+            if self.attrname is not None:
+                predicate.equality = (self.attrname, other)
+            return predicate
     def __lt__(self, other):
         if isinstance(other, Function):
             return Function(lambda obj: self.fn(obj) < other(obj))
@@ -91,7 +99,7 @@ class Function(object):
 
 def attr(name):
     "For use in standard higher order functions."
-    return Function(lambda obj: getattr(obj, name))
+    return Function(lambda obj: getattr(obj, name), attrname=name)
 
 
 def method(name, *args, **kwargs):
@@ -2,7 +2,11 @@
 Base functionality for synchronization messages.
 """
 
+import time
 import inspect
+import collections
+import threading
+import json
 
 from dbsync.lang import *
 from dbsync.utils import get_pk, properties_dict, construct_bare
@@ -11,17 +15,93 @@ from dbsync import models
 from dbsync.messages.codecs import decode_dict, encode_dict
 
 
+class ObjectLayout(object):
+    """
+    Column layout shared by the wrapped objects of a model: the model
+    name, the column names, and the position of each column in the
+    values of the objects.
+    """
+
+    __slots__ = ('model_name', 'keys', 'positions')
+
+    def __init__(self, mname, keys):
+        self.model_name = mname
+        self.keys = keys
+        self.positions = dict((k, i) for i, k in enumerate(keys))
+
+
+#: Maximum number of layouts kept for new objects to share. Partial
+#  pushes can bring any subset of the columns of a model, so the
+#  layouts are bounded. Objects keep their layout after it's dropped;
+#  only new objects stop sharing it.
+max_layouts = 1024
+
+#: Layouts in use, mapped to pairs of (model name, column names), and
+#  those pairs in order of creation, to drop the oldest first.
+_layouts = {}
+_layouts_order = collections.deque()
+_layouts_lock = threading.Lock()
+
+def object_layout(mname, keys):
+    "Returns the shared layout for *mname* and the *keys* tuple."
+    layout = _layouts.get((mname, keys), None)
+    if layout is None:
+        with _layouts_lock:
+            layout = _layouts.get((mname, keys), None)
+            if layout is None:
+                layout = _layouts[(mname, keys)] = ObjectLayout(
+                    intern(str(mname)), keys)
+                _layouts_order.append((mname, keys))
+                while len(_layouts_order) > max_layouts:
+                    del _layouts[_layouts_order.popleft()]
+    return layout
+
+
 class ObjectType(object):
-    "Wrapper for tracked objects."
+    """
+    Wrapper for tracked objects.
+
+    Column values are stored in a tuple, and the column names in a
+    layout shared by all the objects of the model with the same
+    columns. Values are read as attributes of the wrapper.
+    """
+
+    __slots__ = ('__pk__', '_layout', '_values')
 
     def __init__(self, mname, pk, **kwargs):
-        self.__model_name__ = mname
+        self._fill(mname, pk, kwargs)
+
+    @classmethod
+    def from_dict(cls, mname, pk, dict_):
+        "Builds a wrapper without copying *dict_* into keyword arguments."
+        obj = cls.__new__(cls)
+        obj._fill(mname, pk, dict_)
+        return obj
+
+    def _fill(self, mname, pk, dict_):
+        items = tuple((k, v) for k, v in dict_.iteritems()
+                      if k != '__model_name__' and k != '__pk__' \
+                          and k != '__keys__')
         self.__pk__ = pk
-        self.__keys__ = []
-        for k, v in kwargs.iteritems():
-            if k != '__model_name__' and k != '__pk__' and k != '__keys__':
-                setattr(self, k, v)
-                self.__keys__.append(k)
+        self._layout = object_layout(mname, tuple(k for k, _ in items))
+        self._values = tuple(v for _, v in items)
+
+    @property
+    def __model_name__(self):
+        return self._layout.model_name
+
+    @property
+    def __keys__(self):
+        return list(self._layout.keys)
+
+    def __getattr__(self, name):
+        if name == '_layout' or name == '_values':
+            raise AttributeError(name) # unset slots
+        position = self._layout.positions.get(name, None)
+        if position is None:
+            raise AttributeError(
+                "'ObjectType' object has no attribute '{0}'".format(name))
+        return self._values[position]
 
     def __repr__(self):
         return u"<ObjectType {0} pk: {1}>".format(
@@ -37,7 +117,7 @@ class ObjectType(object):
         return self.__pk__
 
     def to_dict(self):
-        return dict((k, getattr(self, k)) for k in self.__keys__)
+        return dict(izip(self._layout.keys, self._values))
 
     def to_mapped_object(self):
         model = synched_models.model_names.\
@@ -46,15 +126,282 @@ class ObjectType(object):
             raise TypeError(
                 "model {0} isn't being tracked".format(self.__model_name__))
         obj = construct_bare(model)
-        for k in self.__keys__:
-            setattr(obj, k, getattr(self, k))
+        for k, v in izip(self._layout.keys, self._values):
+            setattr(obj, k, v)
         return obj
 
 
+class ObjectSet(object):
+    """
+    Set of wrapped objects of a single model, indexed by primary key.
+
+    Iteration yields the wrapped objects, while membership and lookups
+    are performed with primary key values.
+
+    If *loader* is given, it should be a procedure of no arguments
+    that returns the wrapped objects of the set. It's called once, on
+    the first access to the set, so that messages can defer the
+    decoding of their payloads until each model is actually used.
+    """
+
+    def __init__(self, objects=(), loader=None):
+        self._index = {}
+        #: Secondary indexes, built on demand: dictionary of (column
+        #  name, dictionary of (value, list of primary keys)), or
+        #  ``False`` for columns that can't be indexed
+        self._secondary = {}
+        self._loader = loader
+        for obj in objects:
+            self.add(obj)
+
+    @property
+    def _objects(self):
+        """
+        The primary key index, loaded if it's still pending. If loading
+        fails the set stays pending, so the error is raised again on
+        the next access instead of the set reading as empty.
+        """
+        if self._loader is not None:
+            index = {}
+            for obj in self._loader():
+                index.setdefault(obj.__pk__, obj)
+            self._index, self._loader = index, None
+        return self._index
+
+    @property
+    def loaded(self):
+        "Whether the objects of this set have been loaded already."
+        return self._loader is None
+
+    def __len__(self):
+        return len(self._objects)
+
+    def __iter__(self):
+        return self._objects.itervalues()
+
+    def __contains__(self, pk):
+        return pk in self._objects
+
+    def add(self, obj):
+        "Adds a wrapped object, if its primary key isn't already in."
+        objects = self._objects
+        if obj.__pk__ in objects:
+            return
+        objects[obj.__pk__] = obj
+        self._secondary.clear()
+
+    def get(self, pk, default=None):
+        "Returns the wrapped object with the given primary key value."
+        return self._objects.get(pk, default)
+
+    def lookup(self, column, value):
+        """
+        Returns a list of the wrapped objects whose *column* equals
+        *value*. The index for *column* is built on the first lookup
+        and reused until the set is modified. Columns with unhashable
+        values (e.g. lists in a JSON column) can't be indexed, so
+        they're scanned instead.
+        """
+        objects = self._objects
+        if column == '__pk__':
+            obj = objects.get(value, None)
+            return [obj] if obj is not None else []
+        index = self._secondary.get(column, None)
+        if index is None:
+            index = {}
+            try:
+                for pk, obj in objects.iteritems():
+                    key = getattr(obj, column, None)
+                    pks = index.get(key, None)
+                    if pks is None:
+                        index[key] = [pk]
+                    else:
+                        pks.append(pk)
+            except TypeError:
+                index = False
+            self._secondary[column] = index
+        if index is False:
+            return [obj for obj in objects.itervalues()
+                    if getattr(obj, column, None) == value]
+        return [objects[pk] for pk in index.get(value, ())]
+
+
+#: Formats for the payload of encoded messages. In the 'rows' format
+#  each model maps to a list of dictionaries, one for each object. In
+#  the 'columns' format each model maps to a dictionary with the
+#  column names under 'columns', and a list of values for each column
+#  under 'values', and the operations of the message are encoded
+#  compactly (see dbsync.messages.records.encode_operations). Decoding
+#  accepts both formats.
+payload_formats = ('rows', 'columns')
+
+
+def encode_objects(model, objects, payload_format='rows', native=False):
+    """
+    Encodes the wrapped *objects* of *model* in the given
+    *payload_format*. If the objects don't share the same columns they
+    are encoded as rows regardless of the format requested.
+    """
+    assert payload_format in payload_formats, \
+        "invalid payload format: {0}".format(payload_format)
+    rows = map(encode_dict(model, native), imap(method('to_dict'), objects))
+    if payload_format == 'rows' or not rows:
+        return rows
+    columns = sorted(rows[0])
+    keys = set(columns)
+    if any(len(row) != len(keys) or any(k not in keys for k in row)
+           for row in rows):
+        return rows
+    return {'columns': columns,
+            'values': [[row[column] for row in rows] for column in columns]}
+
+
+def _raw_rows(raw_objects):
+    "Yields the encoded dictionaries of *raw_objects*, in either format."
+    if isinstance(raw_objects, dict):
+        columns = raw_objects['columns']
+        for values in izip(*raw_objects['values']):
+            yield dict(izip(columns, values))
+    else:
+        for dict_ in raw_objects:
+            yield dict_
+
+
+def _raw_count(raw_objects, pk):
+    """
+    Returns the number of objects in *raw_objects*, in either format,
+    checking without decoding them that each has a value for the
+    primary key *pk*. Raises a KeyError otherwise.
+    """
+    if isinstance(raw_objects, dict):
+        columns, values = raw_objects['columns'], raw_objects['values']
+        if pk not in columns or len(columns) != len(values):
+            raise KeyError(pk)
+        pks = values[columns.index(pk)]
+        if any(len(column) != len(pks) for column in values):
+            raise KeyError(pk)
+    else:
+        pks = [dict_.get(pk, None) if isinstance(dict_, dict) else None
+               for dict_ in raw_objects]
+    if any(value is None for value in pks):
+        raise KeyError(pk)
+    return len(pks)
+
+
+class PayloadError(Exception):
+    "Raised when the encoded objects of a message can't be decoded."
+
+
+def _payload_loader(mname, model, raw_objects, native=False):
+    """
+    Returns a procedure that decodes *raw_objects*, the encoded
+    objects of *model* in any of the payload formats, into wrapped
+    objects. Values that can't be decoded raise a PayloadError.
+    """
+    def load():
+        pk = get_pk(model)
+        decode_object = decode_dict(model, native)
+        for dict_ in _raw_rows(raw_objects):
+            try:
+                decoded = decode_object(dict_)
+            except (TypeError, ValueError, ArithmeticError) as e:
+                raise PayloadError(mname, dict_[pk], *e.args)
+            yield ObjectType.from_dict(mname, decoded[pk], decoded)
+    return load
+
+
+def object_properties(obj, include_extensions=True, stats=None,
+                      columns=None):
+    """
+    Returns the dictionary of values of the mapped object *obj* that
+    goes in messages, including the extensions of its model if
+    *include_extensions* is ``True``. If *columns* is given, only those
+    columns and the primary key are included.
+
+    If *stats* is given, the time spent loading extensions is added to
+    its 'extension_time' entry.
+    """
+    properties = properties_dict(obj)
+    if columns is not None:
+        pk = get_pk(type(obj))
+        properties = dict((k, v) for k, v in properties.iteritems()
+                          if k == pk or k in columns)
+    extensions = model_extensions.get(type(obj).__name__, None) \
+        if include_extensions else None
+    if extensions:
+        start = time.time()
+        for field, ext in extensions.iteritems():
+            _, loadfn, _, _ = ext
+            properties[field] = loadfn(obj)
+        if stats is not None:
+            stats['extension_time'] += time.time() - start
+    return properties
+
+
+def _empty_stats():
+    "Returns the counters kept for each model (see BaseMessage.stats)."
+    return {'objects': 0,
+            'operations': 0,
+            'extension_time': 0.0,
+            'encode_time': 0.0}
+
+
+def iterencode(payload, fields=None, chunk_size=64 * 1024, lists=None):
+    """
+    Yields the JSON text of an encoded message in chunks of about
+    *chunk_size* characters.
+
+    *payload* is an iterable of pairs of (model name, iterable of
+    encoded objects), and *fields* a dictionary with the rest of the
+    entries of the message. *lists* may map more entries to iterables
+    of encoded items, which are written as lists. Objects and items
+    are converted to text one at a time, as they are taken from the
+    iterables, so the whole text is never held in memory. The payload
+    is written in the 'rows' format.
+    """
+    encoder = json.JSONEncoder()
+    def items(iterable):
+        yield '['
+        for i, item in enumerate(iterable):
+            if i: yield ', '
+            yield encoder.encode(item)
+        yield ']'
+    def pieces():
+        yield '{"payload": {'
+        for i, (name, objects) in enumerate(payload):
+            if i: yield ', '
+            yield encoder.encode(name)
+            yield ': '
+            for piece in items(objects):
+                yield piece
+        yield '}'
+        for k, iterable in (lists or {}).iteritems():
+            yield ', '
+            yield encoder.encode(k)
+            yield ': '
+            for piece in items(iterable):
+                yield piece
+        for k, v in (fields or {}).iteritems():
+            yield ', '
+            yield encoder.encode(k)
+            yield ': '
+            yield encoder.encode(v)
+        yield '}'
+    chunk, size = [], 0
+    for piece in pieces():
+        chunk.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield "".join(chunk)
+
+
 class MessageQuery(object):
     "Query over internal structure of a message."
 
-    def __init__(self, target, payload):
+    def __init__(self, target, payload, objects=None, records=None):
         if target == models.Operation or \
                 target == models.Version or \
                 target == models.Node:
@@ -67,31 +414,58 @@ class MessageQuery(object):
             raise TypeError(
                 "query expected a class or string, got %s" % type(target))
         self.payload = payload
+        #: Operations and versions of the message, mapped to
+        #  'models.Operation' and 'models.Version', kept apart from
+        #  the payload so it doesn't need to be copied.
+        self.records = records if records is not None else {}
+        #: The queried collection, narrowed down by filters.
+        self.objects = objects if objects is not None \
+            else self.records.get(self.target,
+                                  payload.get(self.target, None))
 
     def query(self, model):
         """
         Returns a new query with a different target, without
         filtering.
         """
-        return MessageQuery(model, self.payload)
+        return MessageQuery(model, self.payload, records=self.records)
 
     def filter(self, predicate):
         """
         Returns a new query with the collection filtered according to
         the predicate applied to the target objects.
+
+        Equality predicates over a single attribute (built with
+        ``attr(name) == value``) are resolved through the indexes of
+        the message instead of scanning the collection.
         """
-        to_filter = self.payload.get(self.target, None)
+        to_filter = self.objects
         if to_filter is None:
             return self
-        return MessageQuery(
-            self.target,
-            dict(self.payload, **{self.target: filter(predicate, to_filter)}))
+        equality = getattr(predicate, 'equality', None)
+        if isinstance(to_filter, ObjectSet) and equality is not None and \
+                isinstance(equality[1], collections.Hashable):
+            return MessageQuery(self.target, self.payload,
+                                to_filter.lookup(*equality), self.records)
+        return MessageQuery(self.target, self.payload,
+                            filter(predicate, to_filter), self.records)
+
+    def get(self, pk):
+        """
+        Returns the object with the given primary key value, or
+        ``None`` if it's not present.
+        """
+        return self.filter(attr('__pk__') == pk).first()
+
+    def pks(self):
+        "Returns a list of the primary key values of the queried objects."
+        return [obj.__pk__ for obj in self.objects or ()]
 
     def __iter__(self):
         "Yields objects mapped to their original type (*target*)."
         m = identity if self.target.startswith('models.') \
             else method('to_mapped_object')
-        lst = self.payload.get(self.target, None)
+        lst = self.objects
         if lst is not None:
             for e in imap(m, lst):
                 yield e
@@ -112,51 +486,133 @@ class MessageQuery(object):
 class BaseMessage(object):
     "The base type for messages with a payload."
 
-    #: dictionary of (model name, set of wrapped objects)
+    #: dictionary of (model name, ObjectSet of wrapped objects)
     payload = None
 
-    def __init__(self, raw_data=None):
+    #: dictionary of (model name, dictionary of counters). Counters are
+    #  'objects', 'operations', 'extension_time' and 'encode_time' (the
+    #  last encoding, in seconds). 'bytes' is added by ``measure``, and
+    #  is missing until then.
+    stats = None
+
+    def __init__(self, raw_data=None, native=False):
+        """
+        *raw_data* is the encoded message, a python dictionary. If
+        *native* is ``True`` its values are taken as they are, since
+        it was carried by a codec that keeps python values (see
+        ``to_json``). That's decided by the transport, never by the
+        contents of *raw_data*.
+        """
         self.payload = {}
+        self.stats = {}
         if raw_data is not None:
-            self._from_raw(raw_data)
+            self._from_raw(raw_data, native)
+
+    def model_stats(self, mname):
+        "Returns the counters for the model named *mname*."
+        stats = self.stats.get(mname, None)
+        if stats is None:
+            stats = self.stats[mname] = _empty_stats()
+        return stats
+
+    def count_operations(self, operations):
+        "Adds *operations* to the counters of their models."
+        for op in operations:
+            model = synched_models.ids.get(op.content_type_id, null_model).model
+            if model is not None:
+                self.model_stats(model.__name__)['operations'] += 1
+
+    def measure(self, dumps=json.dumps, payload_format='rows', native=False):
+        """
+        Fills the 'bytes' counter of each model with the size of its
+        payload encoded in *payload_format* (and with native values if
+        *native*) by the *dumps* encoder, and returns the stats.
+
+        The payload is encoded anew for this, which loads the objects
+        of messages decoded from raw data, so it's only done on demand.
+        """
+        for k, objects in self.payload.iteritems():
+            model = synched_models.model_names.get(k, null_model).model
+            if model is not None:
+                self.model_stats(k)['bytes'] = len(dumps(
+                        encode_objects(model, objects, payload_format, native)))
+        return self.stats
 
-    def _from_raw(self, data):
+    def _from_raw(self, data, native=False):
         getm = lambda k: synched_models.model_names.get(k, null_model).model
         for k, v, m in ifilter(lambda (k, v, m): m is not None,
                                imap(lambda (k, v): (k, v, getm(k)),
                                     data['payload'].iteritems())):
-            self.payload[k] = set(
-                map(lambda dict_: ObjectType(k, dict_[get_pk(m)], **dict_),
-                    imap(decode_dict(m), v)))
+            # objects are decoded when the model is first queried, but
+            # their primary keys are checked now
+            count = _raw_count(v, get_pk(m))
+            self.payload[k] = ObjectSet(
+                loader=_payload_loader(k, m, v, native))
+            self.model_stats(k)['objects'] = count
 
     def query(self, model):
         "Returns a query object for this message."
         return MessageQuery(model, self.payload)
 
-    def to_json(self):
-        "Returns a JSON-friendly python dictionary."
+    def to_json(self, payload_format='rows', native=False):
+        """
+        Returns a JSON-friendly python dictionary. The payload is
+        encoded in *payload_format*, one of ``payload_formats``.
+
+        If *native* is ``True``, dates, binary strings and decimals
+        are left as python values, for codecs that carry them as they
+        are (see dbsync.messages.binary). The result isn't
+        JSON-friendly then, and it must be decoded with *native* set
+        as well.
+        """
         encoded = {}
         encoded['payload'] = {}
         for k, objects in self.payload.iteritems():
             model = synched_models.model_names.get(k, null_model).model
             if model is not None:
-                encoded['payload'][k] = map(encode_dict(model),
-                                            imap(method('to_dict'), objects))
+                start = time.time()
+                encoded['payload'][k] = encode_objects(
+                    model, objects, payload_format, native)
+                self.model_stats(k)['encode_time'] = time.time() - start
         return encoded
 
-    def add_object(self, obj, include_extensions=True):
-        "Adds an object to the message, if it's not already in."
+    def _encode_fields(self, payload_format='rows', native=False):
+        "Returns the encoded entries of the message besides the payload."
+        return {}
+
+    def iterencode(self, chunk_size=64 * 1024, **fields):
+        """
+        Yields the JSON text of the message in chunks, encoding the
+        payload object by object (see ``iterencode``). Keyword
+        arguments are added as entries of the message.
+        """
+        def payload():
+            for k, objects in self.payload.iteritems():
+                model = synched_models.model_names.get(k, null_model).model
+                if model is not None:
+                    yield k, imap(encode_dict(model),
+                                  imap(method('to_dict'), objects))
+        encoded = self._encode_fields()
+        encoded.update(fields)
+        return iterencode(payload(), encoded, chunk_size)
+
+    def add_object(self, obj, include_extensions=True, columns=None):
+        """
+        Adds an object to the message, if it's not already in. If
+        *columns* is given, only those columns and the primary key of
+        the object are added.
+        """
         class_ = type(obj)
         classname = class_.__name__
-        obj_set = self.payload.get(classname, set())
-        if ObjectType(classname, getattr(obj, get_pk(class_))) in obj_set:
+        obj_set = self.payload.get(classname, None)
+        if obj_set is None:
+            obj_set = self.payload[classname] = ObjectSet()
+        pk = getattr(obj, get_pk(class_))
+        if pk in obj_set:
             return self
-        properties = properties_dict(obj)
-        if include_extensions:
-            for field, ext in model_extensions.get(classname, {}).iteritems():
-                _, loadfn, _, _ = ext
-                properties[field] = loadfn(obj)
-        obj_set.add(ObjectType(
-                classname, getattr(obj, get_pk(class_)), **properties))
-        self.payload[classname] = obj_set
+        stats = self.model_stats(classname)
+        obj_set.add(ObjectType.from_dict(
+                classname, pk,
+                object_properties(obj, include_extensions, stats, columns)))
+        stats['objects'] += 1
         return self
@@ -0,0 +1,200 @@
+"""
+.. module:: messages.binary
+   :synopsis: A binary codec for messages.
+
+An alternative to JSON for the bodies of requests and responses. It
+encodes the dictionaries built by ``to_json(native=True)`` with typed,
+length-prefixed values, so binary columns travel as raw bytes and
+dates and times as fixed-width integers, instead of base64 strings and
+lists of numbers.
+
+Every encoded value starts with a one-byte tag:
+
+- ``N``, ``T``, ``F``: ``None``, ``True`` and ``False``
+- ``i``: signed 64-bit integer
+- ``I``: integer out of the 64-bit range, as a length-prefixed string
+- ``f``: 64-bit float
+- ``s``: unicode string, length-prefixed UTF-8
+- ``b``: byte string, length-prefixed
+- ``m``: decimal, as a length-prefixed string
+- ``D``: datetime, as signed 64-bit microseconds since the epoch
+- ``a``: date, as signed 32-bit days since the epoch
+- ``t``: time, as signed 64-bit microseconds since midnight
+- ``l``: list, a 32-bit count followed by the items
+- ``d``: dictionary, a 32-bit count followed by the keys and values
+
+Lengths and counts are unsigned 32-bit integers. All numbers are big
+endian. The encoded document starts with ``MAGIC``.
+"""
+
+import struct
+import datetime
+import decimal
+import cStringIO
+
+
+#: Content type used to negotiate the codec through HTTP headers.
+CONTENT_TYPE = "application/x-dbsync-binary"
+
+#: Prefix of every encoded document, including the format version.
+MAGIC = "DBS\x01"
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+
+_length = struct.Struct(">I")
+_int64 = struct.Struct(">q")
+_int32 = struct.Struct(">i")
+_float64 = struct.Struct(">d")
+
+_MIN_INT64 = -(1 << 63)
+_MAX_INT64 = (1 << 63) - 1
+
+
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def _encode(value, out):
+    "Appends the encoded *value* to the list of strings *out*."
+    if value is None:
+        out.append("N")
+    elif value is True:
+        out.append("T")
+    elif value is False:
+        out.append("F")
+    elif isinstance(value, (int, long)):
+        if _MIN_INT64 <= value <= _MAX_INT64:
+            out.append("i" + _int64.pack(value))
+        else:
+            digits = str(value)
+            out.append("I" + _length.pack(len(digits)) + digits)
+    elif isinstance(value, float):
+        out.append("f" + _float64.pack(value))
+    elif isinstance(value, unicode):
+        text = value.encode('utf-8')
+        out.append("s" + _length.pack(len(text)) + text)
+    elif isinstance(value, (str, bytearray, buffer)):
+        data = str(value)
+        out.append("b" + _length.pack(len(data)) + data)
+    elif isinstance(value, decimal.Decimal):
+        digits = str(value)
+        out.append("m" + _length.pack(len(digits)) + digits)
+    elif isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            raise ValueError("can't encode timezone-aware datetimes", value)
+        out.append("D" + _int64.pack(_microseconds(value - _EPOCH)))
+    elif isinstance(value, datetime.date):
+        out.append("a" + _int32.pack(value.toordinal() - _EPOCH_ORDINAL))
+    elif isinstance(value, datetime.time):
+        if value.tzinfo is not None:
+            raise ValueError("can't encode timezone-aware times", value)
+        out.append("t" + _int64.pack(
+                ((value.hour * 60 + value.minute) * 60 + value.second) * \
+                    1000000 + value.microsecond))
+    elif isinstance(value, (list, tuple)):
+        out.append("l" + _length.pack(len(value)))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out.append("d" + _length.pack(len(value)))
+        for k, v in value.iteritems():
+            _encode(k, out)
+            _encode(v, out)
+    else:
+        raise TypeError("can't encode value of type {0}".format(
+                type(value).__name__), value)
+
+
+def dumps(value):
+    "Encodes *value*, usually a dictionary, into a string."
+    out = [MAGIC]
+    _encode(value, out)
+    return "".join(out)
+
+
+class Decoder(object):
+    """
+    Decodes values from a file-like object *stream*, reading only
+    what each value requires.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _read(self, size):
+        data = self.stream.read(size)
+        if len(data) != size:
+            raise ValueError("truncated binary document")
+        return data
+
+    def _sized(self):
+        return self._read(_length.unpack(self._read(4))[0])
+
+    def read_header(self):
+        "Consumes the document prefix, failing if it isn't ``MAGIC``."
+        if self._read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a binary dbsync document")
+
+    def read_tag(self):
+        return self._read(1)
+
+    def read_count(self):
+        "Reads the count of items of a list or dictionary."
+        return _length.unpack(self._read(4))[0]
+
+    def read_value(self, tag=None):
+        "Reads a whole value, or the rest of it if *tag* was consumed."
+        if tag is None:
+            tag = self.read_tag()
+        if tag == "N": return None
+        if tag == "T": return True
+        if tag == "F": return False
+        if tag == "i": return _int64.unpack(self._read(8))[0]
+        if tag == "I": return int(self._sized())
+        if tag == "f": return _float64.unpack(self._read(8))[0]
+        if tag == "s": return self._sized().decode('utf-8')
+        if tag == "b": return self._sized()
+        if tag == "m": return decimal.Decimal(self._sized())
+        if tag == "D":
+            return _EPOCH + datetime.timedelta(
+                microseconds=_int64.unpack(self._read(8))[0])
+        if tag == "a":
+            return datetime.date.fromordinal(
+                _int32.unpack(self._read(4))[0] + _EPOCH_ORDINAL)
+        if tag == "t":
+            micros = _int64.unpack(self._read(8))[0]
+            seconds, microsecond = divmod(micros, 1000000)
+            minutes, second = divmod(seconds, 60)
+            hour, minute = divmod(minutes, 60)
+            return datetime.time(hour, minute, second, microsecond)
+        if tag == "l":
+            return [self.read_value() for _ in xrange(self.read_count())]
+        if tag == "d":
+            result = {}
+            for _ in xrange(self.read_count()):
+                k = self.read_value()
+                result[k] = self.read_value()
+            return result
+        raise ValueError("invalid tag in binary document", tag)
+
+
+def load(stream):
+    "Decodes a value from the file-like object *stream*."
+    decoder = Decoder(stream)
+    decoder.read_header()
+    return decoder.read_value()
+
+
+def loads(data):
+    "Decodes a value from the string *data*."
+    return load(cStringIO.StringIO(data))
+
+
+def accepts(accept_header):
+    """
+    Whether an HTTP Accept header value lists the binary content type,
+    for servers to choose the codec of their responses.
+    """
+    return any(part.split(";")[0].strip() == CONTENT_TYPE
+               for part in (accept_header or "").split(","))
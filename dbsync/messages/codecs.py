@@ -40,45 +40,92 @@ def _encode_table(type_):
         return str
     return identity
 
-#: Encodes a python value into a JSON-friendly python value.
-encode = lambda t: guard(_encode_table(t))
+#: Encodes a python value into a JSON-friendly python value. If
+#  *native* is ``True``, the value is left as it is, for codecs that
+#  carry python values (see dbsync.messages.binary).
+encode = lambda t, native=False: \
+    identity if native else guard(_encode_table(t))
 
-def encode_dict(class_):
+def encode_dict(class_, native=False):
     """
     Returns a function that transforms a dictionary, mapping the
     types to simpler ones, according to the given mapped class.
+
+    If *native* is ``True``, the values are left as they are and only
+    the keys that aren't columns are dropped.
     """
-    types = types_dict(class_)
-    encodings = dict((k, encode(t)) for k, t in types.iteritems())
-    return lambda dict_: dict((k, encodings[k](v))
-                              for k, v in dict_.iteritems()
-                              if k in encodings)
+    return _codecs_for(class_)[2 if native else 0]
 
 
 def _decode_table(type_):
     "*type_* is a SQLAlchemy data type."
     if isinstance(type_, types.Date):
-        return partial(apply, datetime.date)
+        return lambda value: datetime.date(*value)
     elif isinstance(type_, types.DateTime):
-        return partial(apply, datetime.datetime)
+        return lambda value: datetime.datetime(*value)
     elif isinstance(type_, types.Time):
-        return partial(apply, datetime.time)
+        return lambda value: datetime.time(*value)
     elif isinstance(type_, types.LargeBinary):
         return base64.standard_b64decode
     elif isinstance(type_, types.Numeric) and type_.asdecimal:
         return decimal.Decimal
     return identity
 
-#: Decodes a value coming from a JSON string into a richer python value.
-decode = lambda t: guard(_decode_table(t))
+#: Decodes a value coming from a JSON string into a richer python
+#  value. If *native* is ``True``, the value is left as it is.
+decode = lambda t, native=False: \
+    identity if native else guard(_decode_table(t))
 
-def decode_dict(class_):
+def decode_dict(class_, native=False):
     """
     Returns a function that transforms a dictionary, mapping the
     types to richer ones, according to the given mapped class.
+
+    If *native* is ``True``, the values are left as they are and only
+    the keys that aren't columns are dropped.
+    """
+    return _codecs_for(class_)[2 if native else 1]
+
+
+def _compile(table, types):
+    """
+    Returns a function that transforms a dictionary according to the
+    conversions given by *table* for the column *types*. Columns
+    without conversion are copied as they are, and ``None`` values
+    are never converted. Keys that aren't columns are dropped.
     """
-    types = types_dict(class_)
-    decodings = dict((k, decode(t)) for k, t in types.iteritems())
-    return lambda dict_: dict((k, decodings[k](v))
-                              for k, v in dict_.iteritems()
-                              if k in decodings)
+    plain = frozenset(k for k, t in types.iteritems() if table(t) is identity)
+    converted = dict((k, table(t)) for k, t in types.iteritems()
+                     if k not in plain)
+    def transform(dict_):
+        result = {}
+        for k, v in dict_.iteritems():
+            if k in plain:
+                result[k] = v
+            else:
+                fn = converted.get(k, None)
+                if fn is not None:
+                    result[k] = fn(v) if v is not None else None
+        return result
+    return transform
+
+
+#: Compiled trios of (encoder, decoder, native key filter), mapped to
+#  mapped classes.
+_codecs = {}
+
+def _codecs_for(class_):
+    "Returns the compiled (encoder, decoder, native key filter) for *class_*."
+    trio = _codecs.get(class_, None)
+    if trio is None:
+        types = types_dict(class_)
+        trio = _codecs[class_] = (_compile(_encode_table, types),
+                                  _compile(_decode_table, types),
+                                  _compile(lambda t: identity, types))
+    return trio
+
+
+@core.extended.listen
+def _invalidate_codecs(model, fieldname):
+    "Drops the compiled codecs of *model*, which has a new field."
+    _codecs.pop(model, None)
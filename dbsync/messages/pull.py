@@ -6,8 +6,6 @@ import datetime
 
 from sqlalchemy import types
 from dbsync.utils import (
-    properties_dict,
-    object_from_dict,
     get_pk,
     parent_references,
     parent_objects,
@@ -22,6 +20,11 @@ from dbsync.core import (
     get_latest_version_id)
 from dbsync.models import Operation, Version
 from dbsync.messages.base import MessageQuery, BaseMessage
+from dbsync.messages.records import (
+    VersionRecord,
+    values_dict,
+    encode_operations,
+    decode_operations)
 from dbsync.messages.codecs import encode, encode_dict, decode, decode_dict
 
 
@@ -46,37 +49,36 @@ class PullMessage(BaseMessage):
     #: List of versions being pulled.
     versions = None
 
-    def __init__(self, raw_data=None):
+    def __init__(self, raw_data=None, native=False):
         """
         *raw_data* must be a python dictionary, normally the
         product of JSON decoding. If not given, the message will be
         empty and should be filled with the appropriate methods
-        (add_*).
+        (add_*). *native* works as in BaseMessage.
         """
-        super(PullMessage, self).__init__(raw_data)
+        super(PullMessage, self).__init__(raw_data, native)
         if raw_data is not None:
-            self._build_from_raw(raw_data)
+            self._build_from_raw(raw_data, native)
         else:
             self.created = datetime.datetime.now()
             self.operations = []
             self.versions = []
 
-    def _build_from_raw(self, data):
-        self.created = decode(types.DateTime())(data['created'])
-        self.operations = map(partial(object_from_dict, Operation),
-                              imap(decode_dict(Operation), data['operations']))
-        self.versions = map(partial(object_from_dict, Version),
-                            imap(decode_dict(Version), data['versions']))
+    def _build_from_raw(self, data, native=False):
+        self.created = decode(types.DateTime(), native)(data['created'])
+        self.operations = decode_operations(data['operations'], native)
+        self.count_operations(self.operations)
+        self.versions = map(
+            VersionRecord.from_dict,
+            imap(decode_dict(Version, native), data['versions']))
 
     def query(self, model):
         "Returns a query object for this message."
-        return MessageQuery(
-            model,
-            dict(self.payload, **{
-                    'models.Operation': self.operations,
-                    'models.Version': self.versions}))
+        return MessageQuery(model, self.payload, records={
+                'models.Operation': self.operations,
+                'models.Version': self.versions})
 
-    def to_json(self):
+    def to_json(self, payload_format='rows', native=False):
         """
         Returns a JSON-friendly python dictionary. Structure::
 
@@ -84,13 +86,22 @@ class PullMessage(BaseMessage):
             operations: list of operations,
             versions: list of versions,
             payload: dictionary with lists of objects mapped to model names
+
+        The payload is encoded in *payload_format*, as described in
+        dbsync.messages.base.payload_formats. If *native* is ``True``,
+        values are left as python values (see BaseMessage.to_json).
         """
-        encoded = super(PullMessage, self).to_json()
-        encoded['created'] = encode(types.DateTime())(self.created)
-        encoded['operations'] = map(encode_dict(Operation),
-                                    imap(properties_dict, self.operations))
-        encoded['versions'] = map(encode_dict(Version),
-                                  imap(properties_dict, self.versions))
+        encoded = super(PullMessage, self).to_json(payload_format, native)
+        encoded.update(self._encode_fields(payload_format, native))
+        return encoded
+
+    def _encode_fields(self, payload_format='rows', native=False):
+        encoded = {}
+        encoded['created'] = encode(types.DateTime(), native)(self.created)
+        encoded['operations'] = encode_operations(
+            self.operations, payload_format, native)
+        encoded['versions'] = map(encode_dict(Version, native),
+                                  imap(values_dict, self.versions))
         return encoded
 
     @session_closing
@@ -171,13 +182,31 @@ class PullMessage(BaseMessage):
         *include_extensions* dictates whether the pull message will
         include model extensions or not.
         """
+        required_objects = self.add_versions_for(request, session=session)
+        required_parents = {}
+        for obj in objects_by_pk(session, required_objects):
+            self.add_object(obj, include_extensions=include_extensions)
+            # add parent objects to resolve conflicts in merge
+            add_parent_pks(required_parents, obj)
+        for parent in objects_by_pk(session, required_parents):
+            self.add_object(parent, include_extensions=include_extensions)
+        return self
+
+    @session_closing
+    def add_versions_for(self, request, session=None):
+        """
+        Adds the versions and operations the given request
+        (PullRequestMessage) is missing, without their objects.
+
+        Returns the primary keys of the objects required by the added
+        operations, in sets mapped to their models.
+        """
         assert isinstance(request, PullRequestMessage), "invalid request"
         versions = session.query(Version)
         if request.latest_version_id is not None:
             versions = versions.\
                 filter(Version.version_id > request.latest_version_id)
         required_objects = {}
-        required_parents = {}
         for v in versions:
             self.versions.append(v)
             for op in v.operations:
@@ -187,31 +216,34 @@ class PullMessage(BaseMessage):
                                          "which isn't being tracked" % model)
                 if model not in pulled_models: continue
                 self.operations.append(op)
+                self.model_stats(model.__name__)['operations'] += 1
                 if op.command != 'd':
                     pks = required_objects.get(model, set())
                     pks.add(op.row_id)
                     required_objects[model] = pks
+        return required_objects
 
-        for model, pks in ((m, batch)
-                           for m, pks in required_objects.iteritems()
-                           for batch in grouper(pks, MAX_SQL_VARIABLES)):
-            for obj in query_model(session, model).filter(
-                    getattr(model, get_pk(model)).in_(list(pks))).all():
-                self.add_object(obj, include_extensions=include_extensions)
-                # add parent objects to resolve conflicts in merge
-                for pmodel, ppk in parent_references(obj,
-                                                     synched_models.models.keys()):
-                    parent_pks = required_parents.get(pmodel, set())
-                    parent_pks.add(ppk)
-                    required_parents[pmodel] = parent_pks
-
-        for pmodel, ppks in ((m, batch)
-                             for m, pks in required_parents.iteritems()
-                             for batch in grouper(pks, MAX_SQL_VARIABLES)):
-            for parent in query_model(session, pmodel).filter(
-                    getattr(pmodel, get_pk(pmodel)).in_(list(ppks))).all():
-                self.add_object(parent, include_extensions=include_extensions)
-        return self
+
+def objects_by_pk(session, required, model=None):
+    """
+    Yields the objects with the primary keys in *required* (sets
+    mapped to models), querying them in batches. If *model* is given,
+    only the objects of that model are yielded.
+    """
+    for m, pks in required.iteritems():
+        if model is not None and m is not model: continue
+        for batch in grouper(pks, MAX_SQL_VARIABLES):
+            for obj in query_model(session, m).filter(
+                    getattr(m, get_pk(m)).in_(list(batch))).all():
+                yield obj
+
+
+def add_parent_pks(required, obj):
+    "Adds the primary keys of the parents of *obj* to *required*."
+    for pmodel, ppk in parent_references(obj, synched_models.models.keys()):
+        pks = required.get(pmodel, set())
+        pks.add(ppk)
+        required[pmodel] = pks
 
 
 class PullRequestMessage(BaseMessage):
@@ -234,37 +266,42 @@ class PullRequestMessage(BaseMessage):
     #  the pull response.
     latest_version_id = None
 
-    def __init__(self, raw_data=None):
+    def __init__(self, raw_data=None, native=False):
         """
         *raw_data* must be a python dictionary. If not given, the
         message should be filled with the or
-        add_unversioned_operations method.
+        add_unversioned_operations method. *native* works as in
+        BaseMessage.
         """
-        super(PullRequestMessage, self).__init__(raw_data)
+        super(PullRequestMessage, self).__init__(raw_data, native)
         if raw_data is not None:
-            self._build_from_raw(raw_data)
+            self._build_from_raw(raw_data, native)
         else:
             self.latest_version_id = get_latest_version_id()
             self.operations = []
 
-    def _build_from_raw(self, data):
-        self.operations = map(partial(object_from_dict, Operation),
-                              imap(decode_dict(Operation), data['operations']))
-        self.latest_version_id = decode(types.Integer())(
+    def _build_from_raw(self, data, native=False):
+        self.operations = decode_operations(data['operations'], native)
+        self.latest_version_id = decode(types.Integer(), native)(
             data['latest_version_id'])
 
     def query(self, model):
         "Returns a query object for this message."
-        return MessageQuery(
-            model,
-            dict(self.payload, **{'models.Operation': self.operations}))
+        return MessageQuery(model, self.payload,
+                            records={'models.Operation': self.operations})
 
-    def to_json(self):
+    def to_json(self, payload_format='rows', native=False):
         "Returns a JSON-friendly python dictionary."
-        encoded = super(PullRequestMessage, self).to_json()
-        encoded['operations'] = map(encode_dict(Operation),
-                                    imap(properties_dict, self.operations))
-        encoded['latest_version_id'] = encode(types.Integer())(
+        encoded = super(PullRequestMessage, self).to_json(
+            payload_format, native)
+        encoded.update(self._encode_fields(payload_format, native))
+        return encoded
+
+    def _encode_fields(self, payload_format='rows', native=False):
+        encoded = {}
+        encoded['operations'] = encode_operations(
+            self.operations, payload_format, native)
+        encoded['latest_version_id'] = encode(types.Integer(), native)(
             self.latest_version_id)
         return encoded
 
@@ -4,14 +4,14 @@ Push message and related.
 
 import datetime
 import hashlib
+from itertools import islice
 
-from sqlalchemy import types
+from sqlalchemy import types, event
 from dbsync.utils import (
-    properties_dict,
-    object_from_dict,
     get_pk,
     parent_objects,
-    query_model)
+    query_model,
+    LRUCache)
 from dbsync.lang import *
 
 from dbsync.core import (
@@ -21,7 +21,102 @@ from dbsync.core import (
     pushed_models)
 from dbsync.models import Node, Operation
 from dbsync.messages.base import MessageQuery, BaseMessage
-from dbsync.messages.codecs import encode, encode_dict, decode, decode_dict
+from dbsync.messages.records import (
+    encode_operations,
+    decode_operations,
+    signed_fields)
+from dbsync.messages.codecs import encode, decode
+
+
+#: Number of operations formatted between updates of a digest.
+_digest_batch = 1024
+
+def _digest(secret, triples):
+    """
+    Returns the hexadecimal key for a push message signed with
+    *secret*. The digest is fed incrementally with the
+    (row_id, content_type_id, command) *triples* of the operations, so
+    the signed text is never built whole.
+    """
+    digest = hashlib.sha512(secret)
+    triples = iter(triples)
+    while True:
+        batch = "".join("&%s#%s#%s" % triple
+                        for triple in islice(triples, _digest_batch))
+        if not batch:
+            break
+        digest.update(batch)
+    return digest.hexdigest()
+
+
+#: Cache of node secrets, mapped to node ids, used to verify messages.
+#  Entries are invalidated when a node is updated or deleted through
+#  the ORM, but only in the process that does it, so they also expire
+#  after a minute for other processes of the server to notice.
+node_secrets = LRUCache(size=1024, ttl=60)
+
+def _node_secret(node_id, session):
+    "Returns the secret of the node with *node_id*, or ``None``."
+    secret = node_secrets.get(node_id, None)
+    if secret is None:
+        secret = session.query(Node.secret).\
+            filter(Node.node_id == node_id).scalar()
+        if secret is not None:
+            node_secrets.set(node_id, secret)
+    return secret
+
+
+@event.listens_for(Node, 'after_update')
+@event.listens_for(Node, 'after_delete')
+def _invalidate_node_secret(mapper, connection, node):
+    node_secrets.discard(node.node_id)
+
+
+def _islegit(key, node_id, triples, session):
+    """
+    Checks *key* against the signature of the node with *node_id*.
+    *triples* is a procedure that returns the signed fields of the
+    operations (see ``_digest``), called only if the node exists.
+    """
+    if key is None or node_id is None: return False
+    secret = _node_secret(node_id, session)
+    return secret is not None and key == _digest(secret, triples())
+
+
+class PushHeader(object):
+    """
+    The part of an encoded push message needed to accept or reject it:
+    the node, the key and the latest version identifier.
+
+    It's decoded from the raw data dictionary without decoding the
+    operations or the payload, so that rejected pushes are cheap to
+    dismiss. Accepted pushes should be decoded with PushMessage.
+    """
+
+    def __init__(self, raw_data, native=False):
+        "*native* works as in BaseMessage."
+        self.node_id = decode(types.Integer(), native)(raw_data['node_id'])
+        self.key = decode(types.String(), native)(raw_data['key'])
+        self.latest_version_id = decode(types.Integer(), native)(
+            raw_data['latest_version_id'])
+        #: Raw operations, which aren't decoded beyond the fields used
+        #  in the signature.
+        self._operations = raw_data['operations']
+
+    @property
+    def has_operations(self):
+        operations = self._operations
+        return bool(operations['commands'] if isinstance(operations, dict)
+                    else operations)
+
+    def _signed(self):
+        # row_id, content_type_id and command aren't transformed by
+        # the codecs, so the raw values sign the same as the decoded ones
+        return signed_fields(self._operations)
+
+    def islegit(self, session):
+        "Checks whether the key for the message is proper."
+        return _islegit(self.key, self.node_id, self._signed, session)
 
 
 class PushMessage(BaseMessage):
@@ -67,37 +162,34 @@ class PushMessage(BaseMessage):
     #: List of unversioned operations
     operations = None
 
-    def __init__(self, raw_data=None):
+    def __init__(self, raw_data=None, native=False):
         """
         *raw_data* must be a python dictionary. If not given, the
         message will be empty and should be filled after
-        instantiation.
+        instantiation. *native* works as in BaseMessage.
         """
-        super(PushMessage, self).__init__(raw_data)
+        super(PushMessage, self).__init__(raw_data, native)
         if raw_data is not None:
-            self._build_from_raw(raw_data)
+            self._build_from_raw(raw_data, native)
         else:
             self.created = datetime.datetime.now()
             self.operations = []
 
-    def _build_from_raw(self, data):
-        self.created = decode(types.DateTime())(data['created'])
-        self.node_id = decode(types.Integer())(data['node_id'])
-        self.key = decode(types.String())(data['key'])
-        self.latest_version_id = decode(types.Integer())(
+    def _build_from_raw(self, data, native=False):
+        self.created = decode(types.DateTime(), native)(data['created'])
+        self.node_id = decode(types.Integer(), native)(data['node_id'])
+        self.key = decode(types.String(), native)(data['key'])
+        self.latest_version_id = decode(types.Integer(), native)(
             data['latest_version_id'])
-        self.operations = map(partial(object_from_dict, Operation),
-                              imap(decode_dict(Operation), data['operations']))
+        self.operations = decode_operations(data['operations'], native)
+        self.count_operations(self.operations)
 
     def query(self, model):
         "Returns a query object for this message."
-        return MessageQuery(
-            model,
-            dict(
-                self.payload,
-                **{'models.Operation': self.operations}))
+        return MessageQuery(model, self.payload,
+                            records={'models.Operation': self.operations})
 
-    def to_json(self):
+    def to_json(self, payload_format='rows', native=False):
         """
         Returns a JSON-friendly python dictionary. Structure::
 
@@ -107,27 +199,34 @@ class PushMessage(BaseMessage):
             latest_version_id: number or null,
             operations: list of operations,
             payload: dictionay with lists of objects mapped to model names
+
+        The payload is encoded in *payload_format*, as described in
+        dbsync.messages.base.payload_formats. If *native* is ``True``,
+        values are left as python values (see BaseMessage.to_json).
         """
-        encoded = super(PushMessage, self).to_json()
-        encoded['created'] = encode(types.DateTime())(self.created)
-        encoded['node_id'] = encode(types.Integer())(self.node_id)
-        encoded['key'] = encode(types.String())(self.key)
-        encoded['latest_version_id'] = encode(types.Integer())(
+        encoded = super(PushMessage, self).to_json(payload_format, native)
+        encoded.update(self._encode_fields(payload_format, native))
+        return encoded
+
+    def _encode_fields(self, payload_format='rows', native=False):
+        encoded = {}
+        encoded['created'] = encode(types.DateTime(), native)(self.created)
+        encoded['node_id'] = encode(types.Integer(), native)(self.node_id)
+        encoded['key'] = encode(types.String(), native)(self.key)
+        encoded['latest_version_id'] = encode(types.Integer(), native)(
             self.latest_version_id)
-        encoded['operations'] = map(encode_dict(Operation),
-                                    imap(properties_dict, self.operations))
+        encoded['operations'] = encode_operations(
+            self.operations, payload_format, native)
         return encoded
 
-    def _portion(self):
-        "Returns part of this message as a string."
-        portion = "".join("&{0}#{1}#{2}".\
-                              format(op.row_id, op.content_type_id, op.command)
-                          for op in self.operations)
-        return portion
+    def _signed(self):
+        "Yields the signed fields of the operations of this message."
+        return ((op.row_id, op.content_type_id, op.command)
+                for op in self.operations)
 
     def _sign(self):
         if self._secret is not None:
-            self.key = hashlib.sha512(self._secret + self._portion()).hexdigest()
+            self.key = _digest(self._secret, self._signed())
 
     def set_node(self, node):
         "Sets the node and key for this message."
@@ -138,16 +237,16 @@ class PushMessage(BaseMessage):
 
     def islegit(self, session):
         "Checks whether the key for this message is proper."
-        if self.key is None or self.node_id is None: return False
-        node = session.query(Node).filter(Node.node_id == self.node_id).first()
-        return node is not None and \
-            self.key == hashlib.sha512(node.secret + self._portion()).hexdigest()
+        return _islegit(self.key, self.node_id, self._signed, session)
 
     @session_closing
     def add_unversioned_operations(self, session=None, include_extensions=True):
         """
         Adds all unversioned operations to this message, including the
         required objects for them to be performed.
+
+        Objects required only by updates that know their changed
+        columns are added with just those columns and the primary key.
         """
         operations = session.query(Operation).\
             filter(Operation.version_id == None).all()
@@ -156,20 +255,34 @@ class PushMessage(BaseMessage):
             raise ValueError("version includes operation linked "\
                                  "to model not currently being tracked")
         required_objects = {}
+        # changed columns of each required object, or None for all
+        required_columns = {}
         for op in operations:
             model = op.tracked_model
             if model not in pushed_models: continue
             self.operations.append(op)
+            self.model_stats(model.__name__)['operations'] += 1
             if op.command != 'd':
                 pks = required_objects.get(model, set())
                 pks.add(op.row_id)
                 required_objects[model] = pks
+                key = (model, op.row_id)
+                columns = required_columns.get(key, set())
+                if op.command == 'u' and op.changed_columns and \
+                        columns is not None:
+                    columns.update(op.changed_columns.split(","))
+                    required_columns[key] = columns
+                else:
+                    required_columns[key] = None
         for model, pks in ((m, batch)
                            for m, pks in required_objects.iteritems()
                            for batch in grouper(pks, MAX_SQL_VARIABLES)):
+            pk_name = get_pk(model)
             for obj in query_model(session, model).filter(
-                    getattr(model, get_pk(model)).in_(list(pks))).all():
-                self.add_object(obj, include_extensions=include_extensions)
+                    getattr(model, pk_name).in_(list(pks))).all():
+                self.add_object(
+                    obj, include_extensions=include_extensions,
+                    columns=required_columns[(model, getattr(obj, pk_name))])
         if self.key is not None:
             # overwrite since it's probably an incorrect key
             self._sign()
@@ -0,0 +1,186 @@
+"""
+.. module:: messages.records
+   :synopsis: Lightweight operations and versions carried by messages.
+
+Messages decoded from raw data hold their operations and versions as
+plain records instead of mapped objects, since building the SQLAlchemy
+instance state for each one is expensive and most are never persisted
+as they are. Records are turned into mapped objects with ``to_model``
+when they need to be added to a session.
+"""
+
+from itertools import repeat
+
+from dbsync.lang import *
+from dbsync.utils import column_properties, properties_dict
+from dbsync.core import tracked_model
+from dbsync.models import Operation, Version
+from dbsync.messages.codecs import encode_dict, decode_dict
+
+
+class Record(object):
+    "Base type for records of a mapped class (the *model* attribute)."
+
+    __slots__ = ()
+
+    #: The mapped class this record stands for.
+    model = None
+
+    def __init__(self, **kwargs):
+        for k in self.__slots__:
+            setattr(self, k, kwargs.get(k, None))
+
+    @classmethod
+    def from_dict(cls, dict_):
+        "Returns a record from a dictionary of attributes."
+        return cls(**dict_)
+
+    def to_dict(self):
+        "Returns a dictionary of the column values of this record."
+        return dict((k, getattr(self, k)) for k in self.__slots__)
+
+    def to_model(self):
+        "Returns a new instance of the mapped class, with the same values."
+        obj = self.model()
+        for k in self.__slots__:
+            setattr(obj, k, getattr(self, k))
+        return obj
+
+
+class OperationRecord(Record):
+    "An operation, behaving like a dbsync.models.Operation."
+
+    __slots__ = tuple(column_properties(Operation))
+
+    model = Operation
+
+    command_options = Operation.command_options
+
+    tracked_model = property(tracked_model)
+
+    references = Operation.references.im_func
+
+    perform = Operation.perform.im_func
+
+    __repr__ = Operation.__repr__.im_func
+
+
+class VersionRecord(Record):
+    "A version, behaving like a dbsync.models.Version."
+
+    __slots__ = tuple(column_properties(Version))
+
+    model = Version
+
+    __repr__ = Version.__repr__.im_func
+
+
+def values_dict(obj):
+    """
+    Returns a dictionary of the column values of *obj*, either a
+    record or a mapped object.
+    """
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    return properties_dict(obj)
+
+
+def _deltas(values):
+    "Yields the differences between consecutive non-null *values*."
+    previous = 0
+    for value in values:
+        if value is None:
+            yield None
+        else:
+            yield value - previous
+            previous = value
+
+
+def _undeltas(deltas):
+    "Inverse of ``_deltas``."
+    previous = 0
+    for delta in deltas:
+        if delta is None:
+            yield None
+        else:
+            previous += delta
+            yield previous
+
+
+def encode_operations(operations, payload_format='rows', native=False):
+    """
+    Encodes the list of *operations*, records or mapped objects.
+
+    In the 'rows' payload format each operation is encoded as a
+    dictionary. In the 'columns' format they're encoded in a compact
+    form: a dictionary with the distinct content type ids under
+    'content_types' and, for each operation, the index of its content
+    type under 'types', its command in the 'commands' string, and its
+    row id, order and version id delta-encoded under 'row_ids',
+    'orders' and 'version_ids' (each number is the difference with the
+    previous one that wasn't null). The changed columns of partial
+    updates, if any, go under 'changed_columns'.
+    """
+    if payload_format != 'columns':
+        return map(encode_dict(Operation, native),
+                   imap(values_dict, operations))
+    content_types = []
+    indexes = {}
+    types = []
+    for op in operations:
+        index = indexes.get(op.content_type_id, None)
+        if index is None:
+            index = indexes[op.content_type_id] = len(content_types)
+            content_types.append(op.content_type_id)
+        types.append(index)
+    encoded = {
+        'content_types': content_types,
+        'types': types,
+        'commands': "".join(op.command for op in operations),
+        'row_ids': list(_deltas(op.row_id for op in operations)),
+        'orders': list(_deltas(op.order for op in operations)),
+        'version_ids': list(_deltas(op.version_id for op in operations))}
+    changed_columns = [op.changed_columns for op in operations]
+    if any(changed_columns):
+        encoded['changed_columns'] = changed_columns
+    return encoded
+
+
+def _compact_columns(encoded):
+    "Yields the row_id, content_type_id and command of each operation."
+    content_types = encoded['content_types']
+    return izip(_undeltas(encoded['row_ids']),
+                (content_types[i] for i in encoded['types']),
+                encoded['commands'])
+
+
+def decode_operations(encoded, native=False):
+    """
+    Decodes the operations of a message into a list of operation
+    records. *encoded* may be in either of the formats of
+    ``encode_operations``.
+    """
+    if not isinstance(encoded, dict):
+        return map(OperationRecord.from_dict,
+                   imap(decode_dict(Operation, native), encoded))
+    return [OperationRecord(row_id=row_id, content_type_id=content_type_id,
+                            command=command, order=order,
+                            version_id=version_id,
+                            changed_columns=changed_columns)
+            for (row_id, content_type_id, command), order, version_id,
+                changed_columns
+            in izip(_compact_columns(encoded),
+                    _undeltas(encoded['orders']),
+                    _undeltas(encoded['version_ids']),
+                    encoded.get('changed_columns', None) or repeat(None))]
+
+
+def signed_fields(encoded):
+    """
+    Yields the row_id, content_type_id and command of the encoded
+    operations, in either format, without decoding the rest.
+    """
+    if isinstance(encoded, dict):
+        return _compact_columns(encoded)
+    return ((op['row_id'], op['content_type_id'], op['command'])
+            for op in encoded)
@@ -13,16 +13,19 @@ class RegisterMessage(object):
     #: The node to be registered in the client application
     node = None
 
-    def __init__(self, raw_data=None):
+    def __init__(self, raw_data=None, native=False):
+        "*native* works as in dbsync.messages.base.BaseMessage."
         if raw_data is not None:
-            self._build_from_raw(raw_data)
+            self._build_from_raw(raw_data, native)
 
-    def _build_from_raw(self, data):
-        self.node = object_from_dict(Node, decode_dict(Node)(data['node']))
+    def _build_from_raw(self, data, native=False):
+        self.node = object_from_dict(
+            Node, decode_dict(Node, native)(data['node']))
 
-    def to_json(self):
+    def to_json(self, native=False):
         encoded = {}
         encoded['node'] = None
         if self.node is not None:
-            encoded['node'] = encode_dict(Node)(properties_dict(self.node))
+            encoded['node'] = encode_dict(Node, native)(
+                properties_dict(self.node))
         return encoded
@@ -2,13 +2,14 @@
 Internal model used to keep track of versions and operations.
 """
 
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, BigInteger
+from sqlalchemy import (
+    Column, Integer, String, Text, DateTime, ForeignKey, BigInteger)
 from sqlalchemy.orm import relationship, backref, validates
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.declarative.api import DeclarativeMeta
 
-from dbsync.lang import *
-from dbsync.utils import get_pk, query_model, properties_dict
+from dbsync.utils import (
+    get_pk, query_model, properties_dict, column_properties)
 from dbsync.logs import get_logger
 
 
@@ -113,6 +114,9 @@ class Operation(Base):
     command = Column(String(1))
     command_options = ('i', 'u', 'd')
     order = Column(Integer, primary_key=True)
+    #: Comma-separated names of the columns changed by an update, or
+    #  null if the whole row is to be considered changed.
+    changed_columns = Column(Text, nullable=True)
 
     version = relationship(Version, backref=backref("operations", lazy="joined"))
 
@@ -155,8 +159,7 @@ class Operation(Base):
         if operation.command == 'i':
             obj = query_model(session, model).\
                 filter(getattr(model, get_pk(model)) == operation.row_id).first()
-            pull_obj = container.query(model).\
-                filter(attr('__pk__') == operation.row_id).first()
+            pull_obj = container.query(model).get(operation.row_id)
             if pull_obj is None:
                 raise OperationError(
                     "no object backing the operation in container", operation)
@@ -191,11 +194,21 @@ class Operation(Base):
                     node_id,
                     operation)
 
-            pull_obj = container.query(model).\
-                filter(attr('__pk__') == operation.row_id).first()
+            pull_obj = container.query(model).get(operation.row_id)
             if pull_obj is None:
                 raise OperationError(
                     "no object backing the operation in container", operation)
+            # the object in the container might hold only the changed
+            # columns, so the rest are kept from the local one
+            missing = [key for key in column_properties(model)
+                       if key not in pull_obj.__dict__]
+            if missing:
+                if obj is None:
+                    raise OperationError(
+                        "partial update of an object that doesn't exist "
+                        "in database", operation)
+                for key in missing:
+                    setattr(pull_obj, key, getattr(obj, key))
             session.merge(pull_obj)
 
         elif operation.command == 'd':
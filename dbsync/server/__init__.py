@@ -14,5 +14,8 @@ from dbsync.server.handlers import (
     after_push,
     handle_push,
     handle_repair,
-    handle_query)
+    handle_query,
+    stream_pull,
+    stream_repair,
+    stream_query)
 from dbsync.server.trim import trim
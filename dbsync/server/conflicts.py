@@ -9,6 +9,20 @@ from dbsync.lang import *
 from dbsync.utils import get_pk, class_mapper, query_model, column_properties
 
 
+def _changed_columns(push_message):
+    """
+    Maps (model, pk) pairs to the columns changed by the partial
+    updates of *push_message*. Objects of other operations aren't
+    mapped, and hold all their columns in the message.
+    """
+    changed = {}
+    for op in push_message.operations:
+        if op.command == 'u' and op.changed_columns:
+            changed[(op.tracked_model, op.row_id)] = \
+                frozenset(op.changed_columns.split(","))
+    return changed
+
+
 def find_unique_conflicts(push_message, session):
     """
     Returns a list of conflicts caused by unique constraints in the
@@ -20,8 +34,24 @@ def find_unique_conflicts(push_message, session):
         columns: tuple of column names in the unique constraint
         new_values: tuple of values that can be used to update the
                     conflicting object.
+
+    Objects of partial updates hold only the changed columns, so the
+    values of the rest are taken from the database.
     """
     conflicts = []
+    changed_columns = _changed_columns(push_message)
+
+    def pushed_values(model, pk, columns):
+        obj = push_message.query(model).get(pk)
+        if obj is None: return None
+        changed = changed_columns.get((model, pk), None)
+        if changed is None:
+            return tuple(getattr(obj, col, None) for col in columns)
+        if not any(col in changed for col in columns): return None
+        current = query_model(session, model).\
+            filter_by(**{get_pk(model): pk}).first()
+        return tuple(getattr(obj if col in changed else current, col, None)
+                     for col in columns)
 
     for pk, model in ((op.row_id, op.tracked_model)
                       for op in push_message.operations
@@ -32,10 +62,8 @@ def find_unique_conflicts(push_message, session):
                                   class_mapper(model).mapped_table.constraints):
 
             unique_columns = tuple(col.name for col in constraint.columns)
-            remote_obj = push_message.query(model).\
-                filter(attr('__pk__') == pk).first()
-            remote_values = tuple(getattr(remote_obj, col, None)
-                                  for col in unique_columns)
+            remote_values = pushed_values(model, pk, unique_columns)
+            if remote_values is None: continue # unchanged
 
             if all(value is None for value in remote_values): continue
             local_obj = query_model(session, model).\
@@ -44,14 +72,12 @@ def find_unique_conflicts(push_message, session):
             local_pk = getattr(local_obj, get_pk(model))
             if local_pk == pk: continue
 
-            push_obj = push_message.query(model).\
-                filter(attr('__pk__') == local_pk).first()
-            if push_obj is None: continue # push will fail
+            new_values = pushed_values(model, local_pk, unique_columns)
+            if new_values is None: continue # push will fail
 
             conflicts.append(
                 {'object': local_obj,
                  'columns': unique_columns,
-                 'new_values': tuple(getattr(push_obj, col)
-                                     for col in unique_columns)})
+                 'new_values': new_values})
 
     return conflicts
@@ -16,26 +16,39 @@ tasked to send the HTTP response).
 
 import datetime
 
+from sqlalchemy import types, and_
 from sqlalchemy.orm import make_transient
 
 from dbsync.lang import *
 from dbsync.utils import (
     generate_secret,
-    properties_dict,
     column_properties,
     get_pk,
     query_model,
+    class_mapper,
     EventRegister)
 from dbsync import core
+from dbsync.server.tracking import tracked_models
 from dbsync.models import (
     Version,
     Node,
     OperationError,
     Operation)
-from dbsync.messages.base import BaseMessage
+from dbsync.messages.base import (
+    BaseMessage,
+    PayloadError,
+    payload_formats,
+    object_properties,
+    iterencode)
+from dbsync.messages.codecs import encode, encode_dict
 from dbsync.messages.register import RegisterMessage
-from dbsync.messages.pull import PullMessage, PullRequestMessage
-from dbsync.messages.push import PushMessage
+from dbsync.messages.pull import (
+    PullMessage,
+    PullRequestMessage,
+    objects_by_pk,
+    add_parent_pks)
+from dbsync.messages.push import PushMessage, PushHeader, node_secrets
+from dbsync.messages.records import values_dict
 from dbsync.server.conflicts import find_unique_conflicts
 from dbsync.logs import get_logger
 
@@ -43,9 +56,21 @@ from dbsync.logs import get_logger
 logger = get_logger(__name__)
 
 
-@core.session_closing
-def handle_query(data, session=None):
-    "Responds to a query request."
+def _payload_format(data):
+    """
+    Returns the payload format requested by the node in *data*. Nodes
+    that don't request one get the 'rows' format, understood by every
+    version of the library.
+    """
+    requested = (data or {}).get('payload_format', None)
+    return requested if requested in payload_formats else 'rows'
+
+
+def _query(data, session):
+    """
+    Returns the model and the database query requested in *data*, or
+    ``None`` if the model isn't tracked.
+    """
     model = core.synched_models.model_names.\
         get(data.get('model', None), core.null_model).model
     if model is None: return None
@@ -54,31 +79,136 @@ def handle_query(data, session=None):
                                        for k, v in data.iteritems()
                                        if k.startswith(mname + '_'))
                    if k and k in column_properties(model))
-    message = BaseMessage()
     q = query_model(session, model)
     if filters:
         q = q.filter_by(**filters)
+    return model, q
+
+
+@core.session_closing
+def handle_query(data, session=None, native=False):
+    """
+    Responds to a query request.
+
+    If *native* is ``True`` the response is meant for the binary codec
+    (see dbsync.messages.binary), instead of JSON.
+    """
+    requested = _query(data, session)
+    if requested is None: return None
+    _, q = requested
+    message = BaseMessage()
     for obj in q:
         message.add_object(obj)
-    return message.to_json()
+    return message.to_json(_payload_format(data), native)
+
+
+#: Number of rows fetched at a time by the streaming handlers.
+stream_batch_size = 1000
+
+
+def _batched(query, model):
+    """
+    Returns *query* set to fetch rows in batches of
+    ``stream_batch_size``, unless *model* loads collections eagerly,
+    which can't be fetched that way.
+    """
+    if any(prop.uselist and prop.lazy in ('joined', 'subquery')
+           for prop in class_mapper(model).relationships):
+        return query
+    return query.yield_per(stream_batch_size)
+
+
+def _rows(session, model, criterion, order_by):
+    """
+    Yields dictionaries with the column values of the rows of *model*
+    that match *criterion*, sorted by *order_by*. Rows are fetched in
+    batches, and mapped objects aren't built for them.
+    """
+    names = column_properties(model)
+    q = session.query(*[getattr(model, name) for name in names]).\
+        filter(criterion).order_by(*order_by).yield_per(stream_batch_size)
+    for row in q:
+        yield dict(izip(names, row))
+
+
+def _stream_objects(session, model, objects, include_extensions=True):
+    "Yields the encoded *objects*, dropping each from the session."
+    encode_object = encode_dict(model)
+    for obj in objects:
+        yield encode_object(object_properties(obj, include_extensions))
+        session.expunge(obj)
+
+
+def stream_query(data, chunk_size=64 * 1024):
+    """
+    Responds to a query request like ``handle_query``, but returns an
+    iterator of chunks of JSON text, to be sent as a chunked response
+    body. Objects are read and encoded one by one as the iterator is
+    consumed.
+    """
+    def chunks():
+        session = core.Session()
+        try:
+            requested = _query(data, session)
+            if requested is None:
+                yield "null"
+                return
+            model, q = requested
+            payload = [(model.__name__,
+                        _stream_objects(session, model, _batched(q, model)))]
+            for chunk in iterencode(payload, chunk_size=chunk_size):
+                yield chunk
+        finally:
+            session.close()
+    return chunks()
 
 
 @core.session_closing
-def handle_repair(data=None, session=None):
-    "Handle repair request. Return whole server database."
+def handle_repair(data=None, session=None, native=False):
+    """
+    Handle repair request. Return whole server database.
+
+    *native* works as in ``handle_query``.
+    """
     include_extensions = 'exclude_extensions' not in (data or {})
     latest_version_id = core.get_latest_version_id(session=session)
     message = BaseMessage()
-    for model in core.synched_models.models.iterkeys():
+    for model in tracked_models:
         for obj in query_model(session, model):
             message.add_object(obj, include_extensions=include_extensions)
-    response = message.to_json()
+    response = message.to_json(_payload_format(data), native)
     response['latest_version_id'] = latest_version_id
     return response
 
 
+def stream_repair(data=None, chunk_size=64 * 1024):
+    """
+    Responds to a repair request like ``handle_repair``, but returns an
+    iterator of chunks of JSON text, to be sent as a chunked response
+    body. The server database is read and encoded object by object as
+    the iterator is consumed, instead of being held in memory.
+    """
+    include_extensions = 'exclude_extensions' not in (data or {})
+    def chunks():
+        session = core.Session()
+        try:
+            latest_version_id = core.get_latest_version_id(session=session)
+            payload = ((model.__name__,
+                        _stream_objects(session, model,
+                                        _batched(query_model(session, model),
+                                                 model),
+                                        include_extensions))
+                       for model in tracked_models)
+            for chunk in iterencode(
+                payload, {'latest_version_id': latest_version_id}, chunk_size):
+                yield chunk
+        finally:
+            session.close()
+    return chunks()
+
+
 @core.with_transaction()
-def handle_register(user_id=None, node_id=None, session=None):
+def handle_register(user_id=None, node_id=None, session=None, native=False):
     """
     Handle a registry request, creating a new node, wrapping it in a
     message and returning it to the client node.
@@ -89,13 +219,17 @@ def handle_register(user_id=None, node_id=None, session=None):
     If *node_id* is given, it will be used instead of creating a new
     node. This allows for node reuse according to criteria specified
     by the programmer.
+
+    *native* works as in ``handle_query``.
     """
     message = RegisterMessage()
     if node_id is not None:
+        # the node is registered again, so its cached secret is dropped
+        node_secrets.discard(node_id)
         node = session.query(Node).filter(Node.node_id == node_id).first()
         if node is not None:
             message.node = node
-            return message.to_json()
+            return message.to_json(native)
     newnode = Node()
     newnode.registered = datetime.datetime.now()
     newnode.registry_user_id = user_id
@@ -103,31 +237,114 @@ def handle_register(user_id=None, node_id=None, session=None):
     session.add(newnode)
     session.flush()
     message.node = newnode
-    return message.to_json()
+    return message.to_json(native)
 
 
 class PullRejected(Exception): pass
 
 
-def handle_pull(data, swell=False, include_extensions=True):
+def handle_pull(data, swell=False, include_extensions=True, native=False):
     """
     Handle the pull request and return a dictionary object to be sent
     back to the node.
 
     *data* must be a dictionary-like object, usually one obtained from
     decoding a JSON dictionary in the POST body.
+
+    *native* works as in ``handle_query``.
+    """
+    message = _pull_message(data, swell, include_extensions)
+    return message.to_json(_payload_format(data), native)
+
+
+def stream_pull(data, swell=False, include_extensions=True,
+                chunk_size=64 * 1024):
+    """
+    Handles the pull request like ``handle_pull``, but returns an
+    iterator of chunks of JSON text, to be sent as a chunked response
+    body. The operations are read once as the iterator starts to be
+    consumed, to gather the primary keys of the objects they require.
+    Then objects, versions and operations are read and encoded in
+    batches, so only those primary keys are held in memory. Versions
+    committed after the iterator starts are left for the next pull.
+
+    *swell* is deprecated as in ``PullMessage.fill_for``.
     """
+    request_message = _pull_request(data)
+    latest_version_id = request_message.latest_version_id
+    def newer(column):
+        return column != None if latest_version_id is None \
+            else column > latest_version_id
+    def chunks():
+        session = core.Session()
+        def pulled(column):
+            return and_(newer(column), column <= last_version_id)
+        def operations():
+            "Yields the missing operations of pulled models, with the model."
+            for op in _rows(session, Operation, pulled(Operation.version_id),
+                            (Operation.version_id, Operation.order)):
+                model = core.synched_models.ids.\
+                    get(op['content_type_id'], core.null_model).model
+                if model is None:
+                    raise ValueError("operation linked to model %s "\
+                                         "which isn't being tracked" % model)
+                if model in core.pulled_models:
+                    yield model, op
+        try:
+            # versions committed while the response is sent are left
+            # for the next pull, so operations, versions and objects agree
+            last_version_id = core.get_latest_version_id(session=session)
+            required = {}
+            for model, op in operations():
+                if op['command'] != 'd':
+                    pks = required.get(model, set())
+                    pks.add(op['row_id'])
+                    required[model] = pks
+            # parents are found in a first pass, so each model is
+            # written once along with the parents referenced to it
+            parents = {}
+            for obj in objects_by_pk(session, required):
+                add_parent_pks(parents, obj)
+                session.expunge(obj)
+            for model, pks in parents.iteritems():
+                required[model] = required.get(model, set()) | pks
+            payload = ((model.__name__,
+                        _stream_objects(session, model,
+                                        objects_by_pk(session, required, model),
+                                        include_extensions))
+                       for model in required)
+            encode_operation = encode_dict(Operation)
+            lists = {'versions': imap(encode_dict(Version),
+                                      _rows(session, Version,
+                                            pulled(Version.version_id),
+                                            (Version.version_id,))),
+                     'operations': (encode_operation(op)
+                                    for _, op in operations())}
+            fields = {'created': encode(types.DateTime())(
+                    datetime.datetime.now())}
+            for chunk in iterencode(payload, fields, chunk_size, lists):
+                yield chunk
+        finally:
+            session.close()
+    return chunks()
+
+
+def _pull_request(data):
+    # the fields of pull requests decode the same with either codec
     try:
-        request_message = PullRequestMessage(data)
+        return PullRequestMessage(data)
     except KeyError:
         raise PullRejected("request object isn't a valid PullRequestMessage", data)
 
+
+def _pull_message(data, swell, include_extensions):
+    request_message = _pull_request(data)
     message = PullMessage()
     message.fill_for(
         request_message,
         swell=swell,
         include_extensions=include_extensions)
-    return message.to_json()
+    return message
 
 
 class PushRejected(Exception): pass
@@ -141,7 +358,7 @@ after_push = EventRegister()
 
 
 @core.with_transaction()
-def handle_push(data, session=None):
+def handle_push(data, session=None, native=False):
     """
     Handle the push request and return a dictionary object to be sent
     back to the node.
@@ -151,33 +368,50 @@ def handle_push(data, session=None):
 
     *data* must be a dictionary-like object, usually the product of
     parsing a JSON string.
+
+    *native* must be ``True`` if *data* was decoded with the binary
+    codec (see dbsync.messages.binary), which should be decided from
+    the content type of the request.
     """
-    message = None
+    # the header is checked before the rest of the message is decoded
+    header = None
     try:
-        message = PushMessage(data)
+        header = PushHeader(data, native)
     except KeyError:
         raise PushRejected("request object isn't a valid PushMessage", data)
     latest_version_id = core.get_latest_version_id(session=session)
-    if latest_version_id != message.latest_version_id:
+    if latest_version_id != header.latest_version_id:
         exc = "version identifier isn't the latest one; "\
-            "given: %s" % message.latest_version_id
+            "given: %s" % header.latest_version_id
         if latest_version_id is None:
             raise PushRejected(exc)
-        if message.latest_version_id is None:
+        if header.latest_version_id is None:
             raise PullSuggested(exc)
-        if message.latest_version_id < latest_version_id:
+        if header.latest_version_id < latest_version_id:
             raise PullSuggested(exc)
         raise PushRejected(exc)
-    if not message.operations:
-        raise PushRejected("message doesn't contain operations")
-    if not message.islegit(session):
-        raise PushRejected("message isn't properly signed")
+    try:
+        if not header.has_operations:
+            raise PushRejected("message doesn't contain operations")
+        if not header.islegit(session):
+            raise PushRejected("message isn't properly signed")
+    except KeyError:
+        raise PushRejected("request object isn't a valid PushMessage", data)
+    message = None
+    try:
+        message = PushMessage(data, native)
+    except KeyError:
+        raise PushRejected("request object isn't a valid PushMessage", data)
 
-    for listener in before_push:
-        listener(session, message)
+    # the payload is decoded as it's queried, from here on
+    try:
+        for listener in before_push:
+            listener(session, message)
 
-    # I) detect unique constraint conflicts and resolve them if possible
-    unique_conflicts = find_unique_conflicts(message, session)
+        # I) detect unique constraint conflicts and resolve them if possible
+        unique_conflicts = find_unique_conflicts(message, session)
+    except PayloadError as e:
+        raise PushRejected("request object isn't a valid PushMessage", *e.args)
     conflicting_objects = set()
     for uc in unique_conflicts:
         obj = uc['object']
@@ -206,6 +440,8 @@ def handle_push(data, session=None):
                          message.node_id)
         raise PushRejected("at least one operation couldn't be performed",
                            *e.args)
+    except PayloadError as e:
+        raise PushRejected("request object isn't a valid PushMessage", *e.args)
 
     # III) insert a new version
     version = Version(created=datetime.datetime.now(), node_id=message.node_id)
@@ -214,7 +450,7 @@ def handle_push(data, session=None):
     # IV) insert the operations, discarding the 'order' column
     for op in sorted(operations, key=attr('order')):
         new_op = Operation()
-        for k in ifilter(lambda k: k != 'order', properties_dict(op)):
+        for k in ifilter(lambda k: k != 'order', values_dict(op)):
             setattr(new_op, k, getattr(op, k))
         session.add(new_op)
         new_op.version = version
@@ -12,6 +12,7 @@ import datetime
 import warnings
 
 from sqlalchemy import event
+from sqlalchemy.orm import Query
 
 from dbsync import core
 from dbsync.models import Operation, Version
@@ -26,6 +27,12 @@ if core.mode == 'client':
 core.mode = 'server'
 
 
+#: Models tracked through this module. The bulk listeners hang off
+#  the global Query class, as those of the client do, so they check
+#  this set instead of the registries shared in core.
+tracked_models = set()
+
+
 def make_listener(command):
     "Builds a listener for the given command (i, u, d)."
     @core.session_committing
@@ -34,7 +41,8 @@ def make_listener(command):
                    core.INTERNAL_SESSION_ATTR,
                    False):
             return
-        if not core.listening:
+        if not core.is_listening(
+            core.SessionClass.object_session(target)):
             logger.warning("dbsync is disabled; "
                            "aborting listener to '{0}' command".format(command))
             return
@@ -59,11 +67,44 @@ def make_listener(command):
     return listener
 
 
+def make_bulk_listener(command):
+    """
+    Builds a listener for bulk updates or deletes (*command* 'u' or
+    'd') issued through ``Query.update`` and ``Query.delete``. It
+    creates one version for the statement and registers an operation
+    for each row matched by the query with a single INSERT ... SELECT,
+    in the transaction of the query, before the statement is executed.
+    """
+    def listener(query, context):
+        session = query.session
+        if getattr(session, core.INTERNAL_SESSION_ATTR, False) or \
+                context.mapper is None or \
+                context.mapper.class_ not in tracked_models:
+            return
+        if not core.is_listening(session):
+            logger.warning("dbsync is disabled; "
+                           "aborting bulk listener to '{0}' command".\
+                               format(command))
+            return
+        connection = session.connection()
+        version_id = connection.execute(
+            Version.__table__.insert().values(
+                created=datetime.datetime.now())).inserted_primary_key[0]
+        logged = connection.execute(core.bulk_operations(
+                query, context.mapper, command, version_id)).rowcount
+        if logged == 0:
+            # the statement doesn't match any row
+            connection.execute(Version.__table__.delete().\
+                                   where(Version.version_id == version_id))
+    return listener
+
+
 def _start_tracking(model, directions):
     if 'pull' in directions:
         core.pulled_models.add(model)
     if 'push' in directions:
         core.pushed_models.add(model)
+    tracked_models.add(model)
     if model in core.synched_models.models:
         return model
     core.synched_models.install(model)
@@ -93,3 +134,12 @@ def track(*directions):
     assert all(d in valid for d in directions), \
         "track only accepts the arguments: {0}".format(', '.join(valid))
     return lambda model: _start_tracking(model, directions)
+
+
+#: Listeners to bulk updates and deletes, mapped to their Query event.
+bulk_listeners = {'before_compile_update': make_bulk_listener('u'),
+                  'before_compile_delete': make_bulk_listener('d')}
+
+if core.bulk_query_events:
+    for identifier, listener in bulk_listeners.iteritems():
+        event.listen(Query, identifier, listener)
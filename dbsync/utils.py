@@ -3,8 +3,11 @@
    :synopsis: Utility functions.
 """
 
+import time
 import random
 import inspect
+import threading
+import collections
 from sqlalchemy.orm import (
     object_mapper,
     class_mapper,
@@ -148,3 +151,61 @@ class EventRegister(object):
         if listener not in self._listeners:
             self._listeners.append(listener)
         return listener
+
+
+class LRUCache(object):
+    """
+    Mapping of limited size that discards the least recently used
+    entries when full. If *ttl* is given, entries also expire that
+    many seconds after being set. It's safe to share between threads.
+    """
+
+    def __init__(self, size=1024, ttl=None):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (value, expiration time or None)
+        self._entries = collections.OrderedDict()
+
+    def _live(self, key):
+        "Returns the entry for *key* if present and not expired."
+        entry = self._entries.get(key, None)
+        if entry is not None and entry[1] is not None and \
+                entry[1] <= time.time():
+            del self._entries[key]
+            return None
+        return entry
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._live(key) is not None
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                return default
+            del self._entries[key]
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (
+                value,
+                time.time() + self.ttl if self.ttl is not None else None)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,13 @@
+"""
+Tests of the server side, kept apart from those of the client since
+each side registers its own listeners. The engine of the library is
+global, so it's set again before these run, in case another suite set
+its own.
+"""
+
+import dbsync
+
+
+def setup():
+    from server_tests.models import engine
+    dbsync.set_engine(engine)
@@ -0,0 +1,46 @@
+from sqlalchemy import Column, Integer, String, ForeignKey, create_engine
+from sqlalchemy.orm import relationship, backref, sessionmaker
+from sqlalchemy.ext.declarative import declarative_base
+
+import dbsync
+from dbsync import server
+
+
+engine = create_engine("sqlite://")
+Session = sessionmaker(bind=engine)
+
+
+Base = declarative_base()
+
+
+@server.track
+class C(Base):
+    __tablename__ = "test_c"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+
+    def __repr__(self):
+        return u"<C id:{0} name:{1}>".format(self.id, self.name)
+
+
+@server.track
+class D(Base):
+    __tablename__ = "test_d"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    c_id = Column(Integer, ForeignKey("test_c.id"))
+
+    # eagerly loaded, which rules out fetching C in batches
+    c = relationship(C, backref=backref("ds", lazy="joined"))
+
+    def __repr__(self):
+        return u"<D id:{0} name:{1} c_id:{2}>".format(
+            self.id, self.name, self.c_id)
+
+
+Base.metadata.create_all(engine)
+dbsync.set_engine(engine)
+dbsync.create_all()
+dbsync.generate_content_types()
@@ -0,0 +1,121 @@
+import json
+from nose.tools import *
+
+from dbsync import models, core
+from dbsync.server import handlers
+from dbsync.messages.pull import PullMessage, PullRequestMessage
+
+from server_tests.models import C, D, Session
+
+
+def addstuff():
+    c1 = C(name="first c")
+    c2 = C(name="second c")
+    d1 = D(name="first d", c=c1)
+    d2 = D(name="second d", c=c1)
+    d3 = D(name="third d", c=c2)
+    session = Session()
+    session.add_all([c1, c2, d1, d2, d3])
+    session.commit()
+
+def setup():
+    pass
+
+@core.with_listening(False)
+def teardown():
+    session = Session()
+    map(session.delete, session.query(D))
+    map(session.delete, session.query(C))
+    map(session.delete, session.query(models.Operation))
+    map(session.delete, session.query(models.Version))
+    session.commit()
+
+
+def pks(message, model):
+    return sorted(message.query(model).pks())
+
+
+@with_setup(setup, teardown)
+def test_stream_query():
+    addstuff()
+    data = {'model': "D", 'D_name': "second d"}
+    streamed = json.loads("".join(handlers.stream_query(data, chunk_size=16)))
+    assert streamed == handlers.handle_query(data)
+    assert [d['name'] for d in streamed['payload']['D']] == ["second d"]
+    assert "".join(handlers.stream_query({'model': "E"})) == "null"
+
+
+@with_setup(setup, teardown)
+def test_stream_repair():
+    addstuff()
+    streamed = json.loads("".join(handlers.stream_repair(chunk_size=16)))
+    expected = handlers.handle_repair()
+    assert streamed['latest_version_id'] == expected['latest_version_id']
+    for mname in ("C", "D"):
+        assert sorted(streamed['payload'][mname]) == \
+            sorted(expected['payload'][mname])
+    assert len(streamed['payload']['C']) == 2
+    assert len(streamed['payload']['D']) == 3
+
+
+@with_setup(setup, teardown)
+def test_stream_pull():
+    addstuff()
+    request = PullRequestMessage()
+    request.latest_version_id = core.get_latest_version_id()
+    session = Session()
+    d2 = session.query(D).filter(D.name == "second d").one()
+    d2.name = "second d modified"
+    session.commit()
+    data = json.loads(json.dumps(request.to_json()))
+    for swell in (False, True):
+        streamed = PullMessage(json.loads("".join(
+                    handlers.stream_pull(data, swell, chunk_size=16))))
+        expected = PullMessage(handlers.handle_pull(data, swell))
+        assert [op.order for op in streamed.operations] == \
+            [op.order for op in expected.operations]
+        assert [v.version_id for v in streamed.versions] == \
+            [v.version_id for v in expected.versions]
+        assert len(streamed.versions) == 1
+        assert pks(streamed, D) == pks(expected, D) == [d2.id]
+        # the parent is included to resolve conflicts
+        assert pks(streamed, C) == pks(expected, C) == [d2.c_id]
+        assert streamed.query(D).first().name == "second d modified"
+    assert_raises(handlers.PullRejected, handlers.stream_pull, {})
+
+
+@with_setup(setup, teardown)
+def test_stream_everything():
+    addstuff()
+    request = PullRequestMessage()
+    request.latest_version_id = None
+    data = json.loads(json.dumps(request.to_json()))
+    original = handlers.stream_batch_size
+    handlers.stream_batch_size = 2
+    try:
+        streamed = PullMessage(json.loads("".join(handlers.stream_pull(data))))
+    finally:
+        handlers.stream_batch_size = original
+    expected = PullMessage(handlers.handle_pull(data))
+    assert [op.order for op in streamed.operations] == \
+        [op.order for op in expected.operations]
+    assert len(streamed.operations) == len(streamed.versions) == 5
+    assert pks(streamed, C) == pks(expected, C)
+    assert pks(streamed, D) == pks(expected, D)
+
+
+@with_setup(setup, teardown)
+def test_stream_pull_snapshot():
+    addstuff()
+    request = PullRequestMessage()
+    request.latest_version_id = None
+    data = json.loads(json.dumps(request.to_json()))
+    stream = handlers.stream_pull(data, chunk_size=16)
+    first = next(stream)
+    # a push committed while the response is being sent
+    session = Session()
+    session.add(C(name="third c"))
+    session.commit()
+    streamed = PullMessage(json.loads(first + "".join(stream)))
+    assert len(streamed.operations) == len(streamed.versions) == 5
+    assert len(pks(streamed, C)) == 2
@@ -0,0 +1,11 @@
+"""
+Tests of the client side. The engine of the library is global, so it's
+set again before these run, in case another suite set its own.
+"""
+
+import dbsync
+
+
+def setup():
+    from tests.models import engine
+    dbsync.set_engine(engine)
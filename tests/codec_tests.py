@@ -1,9 +1,18 @@
 from nose.tools import *
 import datetime
 import decimal
+import json
 
+from dbsync import core, client
+from dbsync.client import net
 from dbsync.messages.codecs import encode, encode_dict, decode, decode_dict
-from sqlalchemy import types
+from dbsync.messages import binary
+from dbsync.messages.pull import PullMessage
+from dbsync.messages.records import VersionRecord
+from sqlalchemy import types, Column, Integer, String, DateTime, Numeric
+from sqlalchemy.ext.declarative import declarative_base
+
+from tests.models import A
 
 
 def test_encode_date():
@@ -33,3 +42,132 @@ def test_encode_float_numeric():
     e = encode(types.Numeric(asdecimal=False))
     d = decode(types.Numeric(asdecimal=False))
     assert num == d(e(num))
+
+
+_Base = declarative_base()
+
+class Sample(_Base):
+    __tablename__ = "codec_sample"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String)
+    created = Column(DateTime)
+    amount = Column(Numeric)
+
+
+def test_encode_dict():
+    row = {'id': 1, 'name': u"sample", 'amount': None,
+           'created': datetime.datetime(2014, 1, 2, 3, 4, 5, 6),
+           'not_a_column': 7}
+    encoded = encode_dict(Sample)(row)
+    assert encoded == {'id': 1, 'name': u"sample", 'amount': None,
+                       'created': [2014, 1, 2, 3, 4, 5, 6]}
+    del row['not_a_column']
+    assert decode_dict(Sample)(encoded) == row
+
+
+def test_codecs_follow_extensions():
+    assert encode_dict(Sample) is encode_dict(Sample)
+    before = encode_dict(Sample)
+    core.extend(Sample, 'extra', types.Date,
+                lambda obj: None, lambda obj, value: None)
+    assert encode_dict(Sample) is not before
+    assert encode_dict(Sample)({'extra': datetime.date(2014, 1, 2)}) == \
+        {'extra': [2014, 1, 2]}
+
+
+def test_binary_roundtrip():
+    value = {u'none': None, u'flags': [True, False], u'int': -(1 << 40),
+             u'big': 1 << 70, u'float': 3.25, u'text': u"\xf1and\xfa",
+             u'bytes': "\x00\xff", u'decimal': decimal.Decimal('3.30'),
+             u'datetime': datetime.datetime(1969, 12, 31, 23, 59, 59, 7),
+             u'date': datetime.date(2014, 1, 2),
+             u'time': datetime.time(13, 14, 15, 16)}
+    assert binary.loads(binary.dumps(value)) == value
+
+
+def test_binary_native_message():
+    now = datetime.datetime(2014, 1, 2, 3, 4, 5, 6)
+    message = PullMessage()
+    message.versions.append(VersionRecord(version_id=1, created=now))
+    message.add_object(A(id=1, name=u"first a"))
+    encoded = message.to_json(native=True)
+    assert encoded['versions'][0]['created'] is now
+    decoded = PullMessage(binary.loads(binary.dumps(encoded)), native=True)
+    assert decoded.versions[0].created == now
+    assert decoded.query(A).get(1).name == u"first a"
+
+
+def test_native_isnt_read_from_the_body():
+    now = datetime.datetime(2014, 1, 2, 3, 4, 5, 6)
+    message = PullMessage()
+    message.versions.append(VersionRecord(version_id=1, created=now))
+    encoded = json.loads(json.dumps(message.to_json()))
+    encoded['native'] = True
+    assert PullMessage(encoded).versions[0].created == now
+
+
+class FakeResponse(object):
+
+    def __init__(self, body, content_type):
+        self.body = body
+        self.headers = {'content-type': content_type}
+
+    @property
+    def content(self):
+        return self.body
+
+    def iter_content(self, chunk_size=1):
+        for i in xrange(0, len(self.body), chunk_size):
+            yield self.body[i:i + chunk_size]
+
+
+def test_read_spooled_body():
+    value = {u'payload': {u'A': [{u'id': i, u'name': u"a"}
+                                 for i in xrange(100)]}}
+    original_size, original_spool = net.spool_size, net._spool
+    net.spool_size = 64 # force the body to disk
+    spooled = []
+    def spool(r, monitor=None):
+        spooled.append(r.headers['content-type'])
+        return original_spool(r, monitor)
+    net._spool = spool
+    try:
+        body = net._read_body(
+            FakeResponse(binary.dumps(value), binary.CONTENT_TYPE),
+            json.loads)
+        assert body == value and net.decoded_native(body)
+        # only bodies for streaming decoders are spooled
+        assert spooled == [binary.CONTENT_TYPE]
+        body = net._read_body(
+            FakeResponse(json.dumps(value), "application/json"),
+            json.loads)
+        assert body == value and not net.decoded_native(body)
+        states = []
+        assert net._read_body(
+            FakeResponse(json.dumps(value), "application/json"),
+            json.loads, states.append) == value
+        assert states[0]['status'] == "connect"
+        assert states[-1]['received'] == len(json.dumps(value))
+        assert net._read_body(
+            FakeResponse("not json", "application/json"),
+            json.loads) is None
+        assert spooled == [binary.CONTENT_TYPE]
+    finally:
+        net.spool_size, net._spool = original_size, original_spool
+
+
+def test_switch_codecs():
+    original = (net.default_encoder, net.default_headers)
+    try:
+        net.default_headers = dict(net.default_headers, **{"X-Custom": "1"})
+        client.set_binary_codec()
+        assert net.encodes_native()
+        assert net.default_headers["Content-Type"] == binary.CONTENT_TYPE
+        assert net.default_headers["X-Custom"] == "1"
+        client.set_json_codec()
+        assert not net.encodes_native()
+        assert net.default_headers["Content-Type"] == "application/json"
+        assert net.default_headers["X-Custom"] == "1"
+    finally:
+        net.default_encoder, net.default_headers = original
@@ -0,0 +1,136 @@
+from nose.tools import *
+import random
+import warnings
+
+from dbsync.lang import *
+from dbsync.utils import get_pk, query_model
+from dbsync import models, core
+from dbsync.client.compression import (
+    _assert_operation_sequence,
+    merged_changes,
+    compress)
+
+from tests.models import A, B, Session
+
+
+def legacy_compress(session):
+    "The query-per-operation compress, kept as reference."
+    unversioned = session.query(models.Operation).\
+        filter(models.Operation.version_id == None).\
+        order_by(models.Operation.order.desc())
+    seqs = group_by(lambda op: (op.row_id, op.content_type_id), unversioned)
+    for seq in seqs.itervalues():
+        _assert_operation_sequence(seq, session)
+    for seq in ifilter(lambda seq: len(seq) > 1, seqs.itervalues()):
+        if seq[-1].command == 'i':
+            if all(op.command == 'u' for op in seq[:-1]):
+                map(session.delete, seq[:-1])
+            elif seq[0].command == 'd':
+                map(session.delete, seq)
+        elif seq[-1].command == 'u':
+            if all(op.command == 'u' for op in seq[:-1]):
+                seq[0].changed_columns = merged_changes(seq)
+                map(session.delete, seq[1:])
+            elif seq[0].command == 'd':
+                map(session.delete, seq[1:])
+    session.flush()
+    Operation = models.Operation
+    for operation in session.query(Operation).\
+            filter(Operation.version_id == None).\
+            order_by(Operation.order.desc()).all():
+        session.flush()
+        model = operation.tracked_model
+        if not model:
+            continue
+        if operation.command in ('i', 'u'):
+            if query_model(session, model, only_pk=True).\
+                    filter_by(**{get_pk(model): operation.row_id}).count() == 0:
+                session.delete(operation)
+                continue
+        if operation.command == 'u':
+            subsequent = session.query(Operation).\
+                filter(Operation.content_type_id == operation.content_type_id,
+                       Operation.version_id == None,
+                       Operation.row_id == operation.row_id,
+                       Operation.order > operation.order).all()
+            if any(op.command == 'i' for op in subsequent) and \
+                    all(op.command != 'd' for op in subsequent):
+                session.delete(operation)
+                continue
+        if session.query(Operation).\
+                filter(Operation.content_type_id == operation.content_type_id,
+                       Operation.command == operation.command,
+                       Operation.version_id == None,
+                       Operation.row_id == operation.row_id,
+                       Operation.order != operation.order).count() > 0:
+            session.delete(operation)
+            continue
+    session.flush()
+    return session.query(Operation).\
+        filter(Operation.version_id == None).\
+        order_by(Operation.order.asc()).all()
+
+
+def snapshot(operations):
+    return [(op.order, op.row_id, op.content_type_id, op.command,
+             op.changed_columns)
+            for op in operations]
+
+
+def table_snapshot(session):
+    return snapshot(session.query(models.Operation).\
+                        order_by(models.Operation.order))
+
+
+def setup():
+    pass
+
+@core.with_listening(False)
+def addrows():
+    session = Session()
+    session.add_all([A(id=pk, name="a") for pk in (1, 2, 3)])
+    session.add_all([B(id=pk, name="b") for pk in (1, 2)])
+    session.commit()
+
+@core.with_listening(False)
+def teardown():
+    session = Session()
+    map(session.delete, session.query(A))
+    map(session.delete, session.query(B))
+    map(session.delete, session.query(models.Operation))
+    session.commit()
+
+
+def random_operations(rnd):
+    content_types = [core.synched_models.models[A].id,
+                     core.synched_models.models[B].id,
+                     -1] # not tracked
+    rows = [(ct, pk) for ct in content_types for pk in (1, 2, 3, 4)]
+    operations = []
+    for ct, pk in rnd.sample(rows, rnd.randint(1, len(rows))):
+        for _ in xrange(rnd.randint(1, 4)):
+            operations.append(models.Operation(
+                    row_id=pk, content_type_id=ct,
+                    command=rnd.choice('iud'),
+                    changed_columns=rnd.choice([None, "name", "id,name"])))
+    rnd.shuffle(operations)
+    return operations
+
+
+@with_setup(addrows, teardown)
+def test_compress_matches_legacy():
+    rnd = random.Random(7)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for _ in xrange(60):
+            session = Session()
+            session.query(models.Operation).delete()
+            session.add_all(random_operations(rnd))
+            session.commit()
+            expected = snapshot(legacy_compress(session))
+            expected_table = table_snapshot(session)
+            session.rollback()
+            assert snapshot(compress(session=session)) == expected
+            assert table_snapshot(session) == expected_table
+            session.rollback()
+            session.close()
@@ -1,11 +1,14 @@
 import logging
+import random
 from nose.tools import *
 
 from dbsync import models, core
 from dbsync.messages.pull import PullMessage
+from dbsync.messages.records import OperationRecord
 from dbsync.client.conflicts import (
     find_direct_conflicts,
-    find_dependency_conflicts)
+    find_dependency_conflicts,
+    find_insert_conflicts)
 
 from tests.models import A, B, Base, Session
 
@@ -89,3 +92,40 @@ def test_find_dependency_conflicts():
     logging.info(conflicts)
     logging.info(expected)
     assert repr(conflicts) == repr(expected)
+
+
+def nested_direct_conflicts(pull_ops, unversioned_ops):
+    return [
+        (pull_op, local_op)
+        for pull_op in pull_ops
+        if pull_op.command == 'u' or pull_op.command == 'd'
+        for local_op in unversioned_ops
+        if local_op.command == 'u' or local_op.command == 'd'
+        if pull_op.row_id == local_op.row_id
+        if pull_op.content_type_id == local_op.content_type_id]
+
+
+def nested_insert_conflicts(pull_ops, unversioned_ops):
+    return [
+        (pull_op, local_op)
+        for local_op in unversioned_ops
+        if local_op.command == 'i'
+        for pull_op in pull_ops
+        if pull_op.command == 'i'
+        if pull_op.row_id == local_op.row_id
+        if pull_op.content_type_id == local_op.content_type_id]
+
+
+def test_conflicts_match_nested_loops():
+    rnd = random.Random(3)
+    def operations():
+        return [OperationRecord(row_id=rnd.randint(1, 8),
+                                content_type_id=rnd.choice((ct_a_id, ct_b_id)),
+                                command=rnd.choice('iud'))
+                for _ in xrange(rnd.randint(0, 30))]
+    for _ in xrange(100):
+        pull_ops, unversioned_ops = operations(), operations()
+        assert find_direct_conflicts(pull_ops, unversioned_ops) == \
+            nested_direct_conflicts(pull_ops, unversioned_ops)
+        assert find_insert_conflicts(pull_ops, unversioned_ops) == \
+            nested_insert_conflicts(pull_ops, unversioned_ops)
@@ -4,8 +4,17 @@ import logging
 import json
 
 from dbsync.lang import *
+from dbsync.utils import properties_dict
 from dbsync import models, core
-from dbsync.messages.pull import PullMessage
+from dbsync.messages.pull import PullMessage, PullRequestMessage
+from dbsync.messages import base
+from dbsync.messages.base import ObjectType, ObjectSet, PayloadError
+from dbsync.messages.records import (
+    OperationRecord,
+    values_dict,
+    encode_operations,
+    decode_operations,
+    signed_fields)
 
 from tests.models import A, B, Session
 
@@ -75,6 +84,9 @@ def test_message_query():
     for op in session.query(models.Operation):
         assert repr(op) == repr(message.query(models.Operation).filter(
                 attr('order') == op.order).all()[0])
+    # queries share the payload of the message
+    assert message.query(B).query(models.Version).payload is message.payload
+    assert message.query(B).query(models.Version).all() == message.versions
     try:
         message.query(1)
         raise Exception("Message query did not fail")
@@ -92,3 +104,199 @@ def test_message_does_not_contaminate_database():
     # test that the are no unversioned operations
     assert not session.query(models.Operation).\
         filter(models.Operation.version_id == None).all()
+
+
+@with_setup(setup, teardown)
+def test_message_pk_lookup():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    version = session.query(models.Version).first()
+    message.add_version(version)
+    message = PullMessage(message.to_json())
+    for b in session.query(B):
+        assert repr(b) == repr(message.query(B).get(b.id))
+        assert repr(b) == repr(message.query(B).filter(
+                attr('__pk__') == b.id).first())
+    assert message.query(B).get(-1) is None
+    assert sorted(message.query(A).pks()) == \
+        sorted(a.id for a in session.query(A))
+
+
+@with_setup(setup, teardown)
+def test_message_fk_lookup():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    version = session.query(models.Version).first()
+    message.add_version(version)
+    message = PullMessage(message.to_json())
+    for a in session.query(A):
+        indexed = message.query(B).filter(attr('a_id') == a.id).all()
+        scanned = message.query(B).filter(lambda b: b.a_id == a.id).all()
+        assert sorted(map(repr, indexed)) == sorted(map(repr, scanned))
+        assert sorted(map(repr, indexed)) == sorted(map(repr, a.bs))
+
+
+@with_setup(setup, teardown)
+def test_message_lazy_decoding():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    version = session.query(models.Version).first()
+    message.add_version(version)
+    message = PullMessage(message.to_json())
+    assert not message.payload['A'].loaded
+    assert not message.payload['B'].loaded
+    message.query(B).all()
+    assert not message.payload['A'].loaded
+    assert message.payload['B'].loaded
+
+
+@with_setup(setup, teardown)
+def test_malformed_payload():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    message.add_version(session.query(models.Version).first())
+    for payload_format in ('rows', 'columns'):
+        raw = json.loads(json.dumps(message.to_json(payload_format)))
+        if payload_format == 'rows':
+            del raw['payload']['B'][0]['id']
+        else:
+            columns = raw['payload']['B']['columns']
+            columns[columns.index('id')] = "missing"
+        # the primary keys are checked before the payload is decoded
+        assert_raises(KeyError, PullMessage, raw)
+
+
+def test_failed_loading_is_retried():
+    attempts = []
+    def loader():
+        attempts.append(None)
+        yield ObjectType(u"A", 1, id=1, name="first a")
+        if len(attempts) == 1:
+            raise PayloadError("A", 2)
+        yield ObjectType(u"A", 2, id=2, name="second a")
+    objects = ObjectSet(loader=loader)
+    assert_raises(PayloadError, len, objects)
+    assert not objects.loaded
+    assert sorted(obj.__pk__ for obj in objects) == [1, 2]
+
+
+def test_unhashable_column_lookup():
+    objects = ObjectSet([ObjectType(u"B", 1, id=1, name=["first", "b"]),
+                         ObjectType(u"B", 2, id=2, name=None)])
+    assert [obj.__pk__ for obj in objects.lookup('name', None)] == [2]
+    query = base.MessageQuery(B, {'B': objects})
+    assert query.filter(attr('name') == None).pks() == [2]
+
+
+def test_object_type_layout():
+    first = ObjectType(u"B", 1, id=1, name="first b", a_id=1)
+    second = ObjectType(u"B", 2, id=2, name="second b", a_id=1)
+    assert first._layout is second._layout
+    assert first.__model_name__ == "B"
+    assert first.name == "first b" and second.a_id == 1
+    assert second.to_dict() == {'id': 2, 'name': "second b", 'a_id': 1}
+    assert not hasattr(first, 'missing')
+    assert repr(first.to_mapped_object()) == repr(B(id=1, name="first b", a_id=1))
+
+
+def test_object_layouts_are_bounded():
+    original = base.max_layouts
+    base.max_layouts = 4
+    try:
+        first = ObjectType(u"B", 1, id=1, name="first b", a_id=1)
+        for i in xrange(10):
+            ObjectType(u"B", i, **{'id': i, 'column{0}'.format(i): i})
+        assert len(base._layouts) == len(base._layouts_order) == 4
+        assert first.name == "first b"
+        again = ObjectType(u"B", 2, id=2, name="second b", a_id=1)
+        assert again._layout is not first._layout
+    finally:
+        base.max_layouts = original
+
+
+@with_setup(setup, teardown)
+def test_message_records():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    version = session.query(models.Version).first()
+    message.add_version(version)
+    decoded = PullMessage(message.to_json())
+    for op, record in izip(message.operations, decoded.operations):
+        assert repr(op) == repr(record)
+        assert record.tracked_model is op.tracked_model
+        assert properties_dict(record.to_model()) == properties_dict(op)
+    for v, record in izip(message.versions, decoded.versions):
+        assert isinstance(record.to_model(), models.Version)
+        assert record.version_id == v.version_id
+
+
+@with_setup(setup, teardown)
+def test_columnar_payload():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    version = session.query(models.Version).first()
+    message.add_version(version)
+    columnar = message.to_json('columns')
+    assert columnar['payload']['B']['columns'] == ['a_id', 'id', 'name']
+    assert len(columnar['payload']['B']['values'][0]) == 3
+    assert PullMessage(columnar).to_json() == message.to_json()
+    assert columnar == json.loads(json.dumps(columnar))
+
+
+def test_compact_operations():
+    operations = [
+        OperationRecord(row_id=3, content_type_id=10, command='i',
+                        order=1, version_id=None),
+        OperationRecord(row_id=2, content_type_id=20, command='u',
+                        order=None, version_id=4),
+        OperationRecord(row_id=9, content_type_id=10, command='d',
+                        order=3, version_id=4)]
+    encoded = encode_operations(operations, 'columns')
+    assert encoded['content_types'] == [10, 20]
+    assert encoded['commands'] == "iud"
+    assert encoded['row_ids'] == [3, -1, 7]
+    assert encoded['orders'] == [1, None, 2]
+    decoded = decode_operations(json.loads(json.dumps(encoded)))
+    assert map(values_dict, decoded) == map(values_dict, operations)
+    assert list(signed_fields(encoded)) == \
+        [(3, 10, 'i'), (2, 20, 'u'), (9, 10, 'd')]
+
+
+@with_setup(setup, teardown)
+def test_stream_encoding():
+    addstuff()
+    session = Session()
+    message = PullMessage()
+    message.add_version(session.query(models.Version).first())
+    streamed = json.loads("".join(message.iterencode(chunk_size=16)))
+    assert streamed == json.loads(json.dumps(message.to_json()))
+
+
+@with_setup(setup, teardown)
+def test_message_stats():
+    addstuff()
+    request = PullRequestMessage()
+    request.latest_version_id = None
+    message = PullMessage()
+    message.fill_for(request, include_extensions=False)
+    assert message.stats['A']['objects'] == 2
+    assert message.stats['B']['operations'] == 3
+    encoded = json.loads(json.dumps(message.to_json()))
+    assert message.stats['B']['encode_time'] >= 0
+    decoded = PullMessage(encoded)
+    assert decoded.stats['A']['objects'] == 2
+    assert decoded.stats['B']['operations'] == 3
+    # counting doesn't load the payload, measuring does
+    assert not decoded.payload['B'].loaded
+    assert 'bytes' not in decoded.stats['B']
+    assert decoded.measure()['B']['bytes'] == \
+        len(json.dumps(encoded['payload']['B']))
+    columns = json.loads(json.dumps(message.to_json('columns')))
+    assert decoded.measure(payload_format='columns')['B']['bytes'] == \
+        len(json.dumps(columns['payload']['B']))
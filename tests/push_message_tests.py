@@ -2,9 +2,18 @@ from nose.tools import *
 import datetime
 import logging
 import json
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from sqlalchemy import create_engine, inspect
 
+import dbsync
+from dbsync.lang import *
 from dbsync import models, core
-from dbsync.messages.push import PushMessage
+from dbsync.utils import generate_secret, LRUCache
+from dbsync.messages.push import PushMessage, PushHeader, node_secrets
 
 from tests.models import A, B, Session
 
@@ -73,3 +82,146 @@ def test_sign_message():
     assert message.islegit(session)
     message.key += "broken"
     assert not message.islegit(session)
+
+
+@with_setup(setup, teardown)
+def test_check_header():
+    addstuff()
+    changestuff()
+    session = Session()
+    message = PushMessage()
+    message.set_node(session.query(models.Node).first())
+    message.add_unversioned_operations()
+    encoded = json.loads(json.dumps(message.to_json()))
+    header = PushHeader(encoded)
+    assert header.latest_version_id == message.latest_version_id
+    assert header.has_operations
+    assert header.islegit(session)
+    encoded['key'] += "broken"
+    assert not PushHeader(encoded).islegit(session)
+
+
+@with_setup(setup, teardown)
+def test_secret_cache_invalidation():
+    addstuff()
+    changestuff()
+    session = Session()
+    node = session.query(models.Node).first()
+    message = PushMessage()
+    message.set_node(node)
+    message.add_unversioned_operations()
+    portion = "".join("&{0}#{1}#{2}".format(
+            op.row_id, op.content_type_id, op.command)
+                      for op in message.operations)
+    assert message.key == hashlib.sha512(node.secret + portion).hexdigest()
+    assert message.islegit(session)
+    assert node.node_id in node_secrets
+    old_secret = node.secret
+    node.secret = generate_secret(128)
+    session.commit()
+    assert node.node_id not in node_secrets
+    assert not message.islegit(session)
+    node.secret = old_secret
+    session.commit()
+    assert message.islegit(session)
+
+
+@with_setup(setup, teardown)
+def test_partial_update_objects():
+    addstuff()
+    session = Session()
+    session.query(models.Operation).update({'version_id': 1})
+    session.commit()
+    changestuff()
+    message = PushMessage()
+    message.add_unversioned_operations()
+    a1 = message.query(A).filter(attr('name') == "first a modified").first()
+    assert a1 is not None
+    b2 = message.payload['B'].get(
+        [op.row_id for op in message.operations
+         if op.command == 'u' and op.tracked_model is B][0])
+    assert sorted(b2.__keys__) == ['a_id', 'id']
+
+
+@with_setup(setup, teardown)
+def test_perform_partial_update():
+    addstuff()
+    session = Session()
+    session.query(models.Operation).update({'version_id': 1})
+    session.commit()
+    changestuff()
+    message = PushMessage()
+    message.add_unversioned_operations()
+    op = [op for op in message.operations
+          if op.command == 'u' and op.tracked_model is B][0]
+    session = Session()
+    b2 = session.query(B).get(op.row_id)
+    b2.name = "second b locally"
+    models.Operation.perform(op, message, session)
+    session.commit()
+    b2 = session.query(B).get(op.row_id)
+    assert (b2.name, b2.a.name) == ("second b locally", "second a")
+    # a partial object can't be created from scratch
+    @core.with_listening(False)
+    def delete():
+        session.delete(b2)
+        session.commit()
+    delete()
+    assert_raises(models.OperationError,
+                  models.Operation.perform, op, message, Session())
+    # but a complete one is merged, even if the columns are known
+    full = PushMessage()
+    full.add_object(B(id=op.row_id, name="second b again", a_id=1))
+    session = Session()
+    models.Operation.perform(op, full, session)
+    session.commit()
+    assert session.query(B).get(op.row_id).name == "second b again"
+
+
+def test_upgrade_schema():
+    engine = core.get_engine()
+    directory = tempfile.mkdtemp()
+    try:
+        old_engine = create_engine(
+            "sqlite:///" + os.path.join(directory, "old.db"))
+        old_engine.execute(
+            "CREATE TABLE sync_operations (row_id INTEGER, "
+            "version_id INTEGER, content_type_id BIGINT, "
+            "command VARCHAR(1), \"order\" INTEGER PRIMARY KEY)")
+        old_engine.execute(
+            "INSERT INTO sync_operations (row_id, content_type_id, command) "
+            "VALUES (1, 1, 'u')")
+        core.set_engine(old_engine)
+        dbsync.create_all()
+        columns = [c['name'] for c in
+                   inspect(old_engine).get_columns("sync_operations")]
+        assert "changed_columns" in columns
+        assert old_engine.execute("SELECT row_id, changed_columns "
+                                  "FROM sync_operations").fetchall() == \
+                                  [(1, None)]
+        dbsync.upgrade_schema() # a second time does nothing
+    finally:
+        core.set_engine(engine)
+        shutil.rmtree(directory)
+
+
+def test_secret_cache_expiration_and_threads():
+    cache = LRUCache(size=8, ttl=0)
+    cache.set(1, "secret")
+    assert 1 not in cache and cache.get(1) is None
+    cache = LRUCache(size=8, ttl=60)
+    errors = []
+    def hammer(seed):
+        try:
+            for i in xrange(2000):
+                key = (i * seed) % 16
+                cache.set(key, i)
+                cache.get(key)
+                cache.discard((key + 1) % 16)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=hammer, args=(seed,))
+               for seed in (1, 3, 5, 7)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert not errors and len(cache) <= 8
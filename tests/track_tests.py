@@ -1,8 +1,16 @@
 import logging
+import os
+import shutil
+import tempfile
+import threading
+import warnings
 from nose.tools import *
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
 
 from dbsync.lang import *
 from dbsync import models, core, client
+from dbsync.client import tracking
 from dbsync.client.compression import (
     compress,
     compressed_operations,
@@ -82,6 +90,52 @@ def test_unsynched_objects_detection():
     assert bool(unsynched_objects()), "unsynched objects weren't detected"
 
 
+@with_setup(setup, teardown)
+def test_unsynched_objects_read_only():
+    addstuff()
+    changestuff()
+    session = Session()
+    before = session.query(models.Operation).count()
+    triads = unsynched_objects()
+    assert session.query(models.Operation).count() == before
+    compress()
+    assert triads == [(op.tracked_model, op.row_id, op.command)
+                      for op in session.query(models.Operation).\
+                          order_by(models.Operation.order)]
+
+
+@with_setup(setup, teardown)
+def test_unsynched_objects_match_compress():
+    addstuff()
+    session = Session()
+    session.query(models.Operation).update({'version_id': 1})
+    session.commit()
+    a1, a2 = session.query(A)
+    b1, b2, b3 = session.query(B)
+    a1.name = "first a modified"
+    session.commit()
+    # deleted and inserted again with the same primary key
+    pk = b1.id
+    session.delete(b1)
+    session.commit()
+    session.add(B(id=pk, name="first b again"))
+    session.commit()
+    # deleted without tracking
+    session.execute(A.__table__.delete().where(A.__table__.c.id == a1.id))
+    session.commit()
+    before = session.query(models.Operation).count()
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        triads = unsynched_objects()
+        assert session.query(models.Operation).count() == before
+        compress()
+    assert triads == [(op.tracked_model, op.row_id, op.command)
+                      for op in session.query(models.Operation).\
+                          filter(models.Operation.version_id == None).\
+                          order_by(models.Operation.order)]
+    assert triads == [(B, pk, 'd'), (B, pk, 'i')]
+
+
 @with_setup(setup, teardown)
 def test_compression_consistency():
     addstuff()
@@ -146,3 +200,316 @@ def test_compression_correctness():
     assert compressed[3].command == 'd'
     assert compressed[4].command == 'u'
     assert compressed[5].command == 'u'
+
+
+@with_setup(setup, teardown)
+def test_in_transaction_capture():
+    client.set_capture_mode('in_transaction')
+    try:
+        addstuff()
+        changestuff()
+        session = Session()
+        session.add(A(name="rolled back"))
+        session.flush()
+        session.rollback()
+    finally:
+        client.set_capture_mode('after_commit')
+    session = Session()
+    commands = [op.command for op in session.query(models.Operation).\
+                    order_by(models.Operation.order)]
+    assert commands.count('i') == 5
+    assert commands.count('u') == 2
+    assert commands.count('d') == 1
+    assert not any(tracking._operations_queues.values())
+
+
+@with_setup(setup, teardown)
+def test_session_scoped_capture():
+    app_session = Session()
+    app_session.add(A(name="pending a"))
+    app_session.flush()
+    other_session = Session()
+    other_session.add(A(name="other a"))
+    core.set_session_listening(other_session, False)
+    other_session.commit()
+    # the other commit doesn't write the operations of the app session
+    assert Session().query(models.Operation).count() == 0
+    app_session.rollback()
+    assert Session().query(models.Operation).count() == 0
+    addstuff()
+    assert Session().query(models.Operation).count() == 5
+
+
+@with_setup(setup, teardown)
+def test_thread_listening():
+    @core.with_listening(False, thread=True)
+    def add():
+        addstuff()
+        assert not core.is_listening()
+    add()
+    assert core.is_listening()
+    assert Session().query(models.Operation).count() == 0
+
+
+def test_concurrent_thread_listening():
+    # in-memory SQLite databases aren't shared between threads
+    directory = tempfile.mkdtemp()
+    engine = create_engine(
+        "sqlite:///" + os.path.join(directory, "threads.db"))
+    Base.metadata.create_all(engine)
+    models.Base.metadata.create_all(engine)
+    ThreadSession = sessionmaker(bind=engine)
+    previous_engine = core.get_engine()
+    core.set_engine(engine)
+    start = threading.Event()
+    errors = []
+    def add(name):
+        try:
+            start.wait()
+            session = ThreadSession()
+            for i in xrange(20):
+                session.add(A(name=name))
+                session.commit()
+            session.close()
+        except Exception as e:
+            errors.append(e)
+    quiet = core.with_listening(False, thread=True)(add)
+    threads = [threading.Thread(target=quiet, args=("quiet",)),
+               threading.Thread(target=add, args=("loud",))]
+    try:
+        for thread in threads: thread.start()
+        start.set()
+        for thread in threads: thread.join()
+        assert not errors, errors
+        session = ThreadSession()
+        loud = set(pk for pk, in session.query(A.id).filter(A.name == "loud"))
+        logged = [op.row_id for op in session.query(models.Operation)]
+        assert len(loud) == 20 and sorted(logged) == sorted(loud)
+        session.close()
+    finally:
+        core.set_engine(previous_engine)
+        engine.dispose()
+        shutil.rmtree(directory)
+
+
+@with_setup(setup, teardown)
+def test_trigger_capture():
+    client.set_capture_mode('triggers')
+    try:
+        addstuff()
+        changestuff()
+        session = Session()
+        session.execute(A.__table__.insert(), [{'name': "bulk a"}] * 3)
+        session.commit()
+        # writes of the library itself aren't registered
+        internal = core.Session()
+        internal.add(A(name="internal a"))
+        internal.commit()
+        internal.close()
+        # read-only procedures of the library don't write at all
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(core.get_engine(), 'before_cursor_execute', record)
+        try:
+            unsynched_objects()
+            core.sync_status(session.query(A).all())
+            core.get_latest_version_id()
+        finally:
+            event.remove(core.get_engine(), 'before_cursor_execute', record)
+        assert statements and \
+            all(s.lstrip().upper().startswith("SELECT") for s in statements)
+    finally:
+        client.set_capture_mode('after_commit')
+    session = Session()
+    commands = [op.command for op in session.query(models.Operation)]
+    assert commands.count('i') == 8
+    assert commands.count('u') == 2
+    assert commands.count('d') == 1
+
+
+@with_setup(setup, teardown)
+def test_trigger_capture_after_rollback():
+    client.set_capture_mode('triggers')
+    try:
+        internal = core.Session()
+        internal.add(A(name="internal a"))
+        internal.flush() # pauses the triggers
+        # as if the connection weren't transactional, the pause stays
+        internal.connection().connection.commit()
+        internal.rollback()
+        internal.close()
+        session = Session()
+        session.add(A(name="user a"))
+        session.commit()
+    finally:
+        client.set_capture_mode('after_commit')
+    session = Session()
+    assert [op.command for op in session.query(models.Operation)] == ['i']
+
+
+@with_setup(setup, teardown)
+def test_bulk_tracking():
+    addstuff()
+    session = Session()
+    session.query(A).filter(A.name == "first a").\
+        update({'name': "first a bulk"}, synchronize_session=False)
+    session.query(B).filter(B.name != "first b").\
+        delete(synchronize_session=False)
+    session.commit()
+    session = Session()
+    ops = session.query(models.Operation).\
+        filter(models.Operation.command != 'i').\
+        order_by(models.Operation.order).all()
+    assert [(op.command, op.tracked_model, op.row_id) for op in ops] == \
+        [('u', A, 1), ('d', B, 2), ('d', B, 3)]
+
+
+@with_setup(setup, teardown)
+def test_changed_columns():
+    addstuff()
+    session = Session()
+    b1 = session.query(B).filter(B.name == "first b").one()
+    b1.name = "first b modified"
+    session.commit()
+    b1.a = session.query(A).filter(A.name == "second a").one()
+    session.commit()
+    updates = session.query(models.Operation).\
+        filter(models.Operation.command == 'u').\
+        order_by(models.Operation.order).all()
+    assert [op.changed_columns for op in updates] == ["name", "a_id"]
+    merged = compressed_operations(updates)
+    assert len(merged) == 1 and merged[0].changed_columns == "a_id,name"
+    session.close()
+    # inserts are compressed with the updates, so version them first
+    session = Session()
+    session.query(models.Operation).update({'version_id': 1})
+    session.commit()
+    b1 = session.query(B).filter(B.name == "first b modified").one()
+    b1.name = "first b again"
+    session.commit()
+    b1.a = session.query(A).filter(A.name == "first a").one()
+    session.commit()
+    ops = compress()
+    assert len(ops) == 1 and ops[0].changed_columns == "a_id,name"
+
+
+@with_setup(setup, teardown)
+def test_coalescing_capture():
+    client.set_coalescing(True)
+    try:
+        for mode in ('after_commit', 'in_transaction'):
+            teardown()
+            client.set_capture_mode(mode)
+            addstuff()
+            changestuff()
+            session = Session()
+            assert [op.command for op in session.query(models.Operation)] == \
+                ['i', 'i', 'i', 'i']
+            session.query(models.Operation).update({'version_id': 1})
+            session.commit()
+            a1, a2 = session.query(A)
+            b1, b2 = session.query(B)
+            a1.name = "first a again"
+            session.commit()
+            a1.name = "first a once more"
+            b1.name = "first b modified"
+            session.commit()
+            session.delete(b1)
+            session.commit()
+            unversioned = session.query(models.Operation).\
+                filter(models.Operation.version_id == None).\
+                order_by(models.Operation.order).all()
+            assert [(op.row_id, op.command) for op in unversioned] == \
+                [(a1.id, 'u'), (b1.id, 'd')]
+            assert unversioned[0].changed_columns == "name"
+            assert [op.order for op in compress()] == \
+                [op.order for op in unversioned]
+            session.close()
+    finally:
+        client.set_capture_mode('after_commit')
+        client.set_coalescing(False)
+
+
+def coalesced_writes():
+    session = Session()
+    a1, a2, a3, a4 = [A(name=name) for name in "1234"]
+    session.add_all([a1, a2, a3, a4])
+    session.commit()
+    a1.name = "1 modified"
+    session.flush()
+    a1.name = "1 again"
+    session.delete(a2)
+    session.commit()
+    session.query(models.Operation).update({'version_id': 1})
+    session.commit()
+    a3.name = "3 modified"
+    a4.name = "4 modified"
+    session.commit()
+    a3.name = "3 again"
+    session.commit()
+    session.delete(a4)
+    session.commit()
+    session.close()
+
+
+def unversioned_log():
+    session = Session()
+    log = [(op.row_id, op.content_type_id, op.command, op.changed_columns)
+           for op in session.query(models.Operation).\
+               filter(models.Operation.version_id == None).\
+               order_by(models.Operation.order)]
+    session.close()
+    return log
+
+
+@with_setup(setup, teardown)
+def test_coalescing_matches_compress():
+    coalesced_writes()
+    compress()
+    expected = unversioned_log()
+    assert [command for _, _, command, _ in expected] == ['u', 'd']
+    client.set_coalescing(True)
+    try:
+        for mode in ('after_commit', 'in_transaction'):
+            teardown()
+            client.set_capture_mode(mode)
+            coalesced_writes()
+            assert unversioned_log() == expected
+            # a commit of several rows takes a query, a delete and an
+            # insert on the log
+            statements = []
+            def record(conn, cursor, statement, *args):
+                if models.Operation.__tablename__ in statement:
+                    statements.append(statement.lstrip().split()[0].upper())
+            session = Session()
+            for a in session.query(A):
+                a.name = a.name + " bulk"
+            event.listen(core.get_engine(), 'before_cursor_execute', record)
+            try:
+                session.commit()
+            finally:
+                event.remove(
+                    core.get_engine(), 'before_cursor_execute', record)
+            assert sorted(statements) == ['DELETE', 'INSERT', 'SELECT']
+            session.close()
+    finally:
+        client.set_capture_mode('after_commit')
+        client.set_coalescing(False)
+
+
+@with_setup(setup, teardown)
+def test_sync_status():
+    addstuff()
+    session = Session()
+    session.query(models.Operation).update({'version_id': 1})
+    session.commit()
+    changestuff()
+    a1, a2 = session.query(A)
+    b1, b2 = session.query(B)
+    node = models.Node()
+    assert core.sync_status([a1, a2, b1, b2, node], session=session) == \
+        {a1: 'pending', a2: 'synced', b1: 'synced', b2: 'pending',
+         node: 'untracked'}
+    assert [core.is_synched(obj) for obj in (a1, a2, b1, b2)] == \
+        [False, True, True, False]